@@ -21,13 +21,17 @@ from rich import print as rprint
 from rich.panel import Panel
 
 from langpatch.config import get_settings
-from langpatch.fs_utils import filter_files, list_tracked_files
+from langpatch.fs_utils import IngestStats, filter_files, list_tracked_files
 from langpatch.git_utils import get_current_branch, get_head_commit, apply_check
-from langpatch.indexer import build_or_update_index
-from langpatch.retriever import retrieve_top_chunks
+from langpatch.budget import BudgetExhausted, ShareExceeded, TokenBudget
+from langpatch.llm import UsageMeter, get_llm
+from langpatch.indexer import build_or_update_index, load_hashes, parse_shard_prefixes
+from langpatch.snapshot import export_index, import_index
+from langpatch.verifier import CACHE_DIR_NAME, verify_patch
+from langpatch.retriever import RetrievalStats, retrieve_top_chunks
 from langpatch.planner import plan_changes
-from langpatch.patcher import generate_file_patch, merge_diffs
-from langpatch.diff_utils import looks_like_unified_diff, sanitize_diff
+from langpatch.patcher import merge_diffs
+from langpatch.repair import RepairStats, generate_with_repair, locate_merged_failure
 
 
 load_dotenv()
@@ -36,6 +40,18 @@ REPO_PATH = os.getenv("REPO_PATH")
 REQUIREMENT = os.getenv("REQUIREMENT", "").strip()
 PATCH_OUTPUT_DIR = os.getenv("PATCH_OUTPUT_DIR", "./patches")
 PATCH_FILE_NAME = os.getenv("PATCH_FILE_NAME", "langpatch.patch")
+# 逗号分隔的相对路径前缀：限定检索范围 / 只重建指定分片
+SCOPE_PATHS = [p for p in os.getenv("SCOPE_PATHS", "").split(",") if p.strip()]
+INDEX_ONLY_SHARDS = [p for p in os.getenv("INDEX_ONLY_SHARDS", "").split(",") if p.strip()]
+# 索引快照：本地没有索引时先从 IMPORT 导入；构建完成后导出到 EXPORT
+# 只设置 EXPORT、不设置 REQUIREMENT 时只建索引并导出（供 CI 使用）
+INDEX_IMPORT_PATH = os.getenv("INDEX_IMPORT_PATH", "").strip()
+INDEX_EXPORT_PATH = os.getenv("INDEX_EXPORT_PATH", "").strip()
+# git apply --check 通过后，在临时 worktree 中编译并运行受影响的测试
+VERIFY_PATCH = os.getenv("VERIFY_PATCH", "1").strip() not in ("", "0", "false")
+
+# 单个文件可用 prompt token 低于该值时，不再生成后续文件
+MIN_FILE_ALLOWANCE = 2_000
 
 DEFAULT_EXCLUDES = [
     ".git",
@@ -52,11 +68,11 @@ def main() -> None:
     if not REPO_PATH:
         rprint("[bold red]未设置 REPO_PATH[/bold red]")
         return
-    if not REQUIREMENT:
+    if not REQUIREMENT and not INDEX_EXPORT_PATH:
         rprint("[bold red]未设置 REQUIREMENT[/bold red]")
         return
 
-    settings = get_settings()
+    settings = get_settings(require_llm=bool(REQUIREMENT))
     repo_root = Path(REPO_PATH).resolve()
     patch_dir = Path(PATCH_OUTPUT_DIR).resolve()
     patch_dir.mkdir(parents=True, exist_ok=True)
@@ -79,36 +95,89 @@ def main() -> None:
     ))
 
     tracked = list_tracked_files(repo_root)
-    files = filter_files(tracked, repo_root, DEFAULT_EXCLUDES)
+    ingest = IngestStats()
+    files = filter_files(
+        tracked, repo_root, DEFAULT_EXCLUDES,
+        max_bytes=settings.max_file_bytes, stats=ingest,
+    )
 
     rprint(f"[cyan]扫描到文件数:[/cyan] {len(files)}")
 
     index_dir = repo_root / ".langpatch_index"
-    build_or_update_index(
+    if INDEX_IMPORT_PATH and not load_hashes(index_dir):
+        try:
+            manifest = import_index(Path(INDEX_IMPORT_PATH), index_dir, settings.embed_model)
+        except (RuntimeError, OSError) as e:
+            # 快照不兼容或不可读：回退为本地构建
+            rprint(f"[yellow]索引快照导入失败，改为本地构建:[/yellow] {e}")
+        else:
+            rprint(
+                f"[green]已导入索引快照[/green] commit={manifest.get('commit')} "
+                f"chunks={sum(s['count'] for s in manifest['shards'])}"
+            )
+
+    index_stats = build_or_update_index(
         repo_root=repo_root,
         index_dir=index_dir,
         files=files,
         embed_model=settings.embed_model,
         max_chars_per_file=settings.max_chars_per_file,
+        max_file_bytes=settings.max_file_bytes,
+        ingest=ingest,
+        shard_prefixes=parse_shard_prefixes(settings.index_shards),
+        only_shards=parse_shard_prefixes(",".join(INDEX_ONLY_SHARDS)) or None,
+        batch_tokens=settings.embed_batch_tokens,
+        embed_processes=settings.embed_processes,
+        coarse=settings.coarse_top_files > 0,
+    )
+
+    rprint(f"[green]Embedding 索引完成[/green] {index_stats.as_dict()}")
+    rprint(
+        f"[cyan]读取字节:[/cyan] {ingest.bytes_read}  "
+        f"[cyan]跳过字节:[/cyan] {ingest.bytes_skipped}  {ingest.as_dict()}"
     )
 
-    rprint("[green]Embedding 索引完成[/green]")
+    if INDEX_EXPORT_PATH:
+        export_index(index_dir, Path(INDEX_EXPORT_PATH), settings.embed_model, commit=head)
+        rprint(f"[green]索引快照已导出:[/green] {INDEX_EXPORT_PATH}")
+        if not REQUIREMENT:
+            return
 
+    retrieval_stats = RetrievalStats()
     chunks = retrieve_top_chunks(
         index_dir=index_dir,
         embed_model=settings.embed_model,
         query=REQUIREMENT,
         top_k=settings.top_k,
+        scope=SCOPE_PATHS,
+        stats=retrieval_stats,
+        coarse_files=settings.coarse_top_files,
+        compare_flat=settings.coarse_compare_flat,
     )
 
     rprint(f"[cyan]命中代码块:[/cyan] {len(chunks)}")
+    rprint(Panel.fit(
+        json.dumps(retrieval_stats.shards, indent=2, ensure_ascii=False),
+        title="分片检索"
+    ))
+    if retrieval_stats.two_stage:
+        rprint(Panel.fit(
+            json.dumps(retrieval_stats.two_stage, indent=2, ensure_ascii=False),
+            title="两阶段检索（文件 -> chunk）"
+        ))
 
     if not chunks:
         rprint("[yellow]未检索到相关代码片段[/yellow]")
         return
 
+    meter = UsageMeter()
+    budget = TokenBudget.from_settings(settings)
     try:
-        plan = plan_changes(settings, REQUIREMENT, chunks)
+        plan = plan_changes(settings, REQUIREMENT, chunks, meter=meter, budget=budget)
+    except BudgetExhausted as e:
+        rprint(f"[bold red]Token 预算耗尽，已中止:[/bold red] {e}")
+        rprint(Panel.fit(json.dumps(budget.report(), indent=2, ensure_ascii=False), title="Token 预算"))
+        return
     except Exception as e:
         rprint(f"[bold red]Planner 失败:[/bold red] {e}")
         return
@@ -120,41 +189,149 @@ def main() -> None:
 
     targets = [x["path"] for x in plan.get("files_to_modify", [])]
     targets += [x["path"] for x in plan.get("new_files", [])]
+    # 同一文件可能被重复列出（或同时出现在修改 / 新增中），只生成一份 diff
+    targets = list(dict.fromkeys(Path(t).as_posix() for t in targets))
 
     if not targets:
         rprint("[yellow]Planner 未返回任何修改目标[/yellow]")
         return
 
-    patches = []
-    for rel_path in targets[: settings.max_files_for_llm]:
-        fp = generate_file_patch(
-            settings=settings,
-            repo_root=repo_root,
-            rel_path=rel_path,
-            requirement=REQUIREMENT,
-            design_notes=plan.get("design_notes", []),
+    # 检索命中的行区间：预算不足时 patcher 只发送这些区域
+    focus: dict = {}
+    for c in chunks:
+        meta = c["meta"]
+        focus.setdefault(meta.get("rel_path"), []).append(
+            (int(meta.get("start_line", 1)), int(meta.get("end_line", 1)))
         )
 
-        diff = sanitize_diff(fp.diff)
-        if not looks_like_unified_diff(diff):
-            raise RuntimeError(f"{rel_path} 输出不是合法 unified diff")
+    targets = targets[: settings.max_files_for_llm]
+    budget.expect_files(len(targets))
 
-        patches.append(fp.__class__(fp.rel_path, diff))
+    stats = RepairStats()
+    patches = []
+    for i, rel_path in enumerate(targets):
+        # 并行候选时每次调用只取该文件预算的 1/n
+        if budget.allowance(1.0 / max(1, settings.patch_candidates)) < MIN_FILE_ALLOWANCE:
+            skipped = targets[i:]
+            budget.degrade(f"预算不足，跳过剩余 {len(skipped)} 个文件: {', '.join(skipped)}")
+            rprint(f"[yellow]Token 预算不足，跳过剩余文件:[/yellow] {skipped}")
+            break
+
+        try:
+            fp = generate_with_repair(
+                settings=settings,
+                repo_root=repo_root,
+                requirement=REQUIREMENT,
+                design_notes=plan.get("design_notes", []),
+                rel_path=rel_path,
+                stats=stats,
+                meter=meter,
+                budget=budget,
+                focus=focus.get(rel_path),
+            )
+        except ShareExceeded as e:
+            budget.degrade(f"跳过 {rel_path}: {e}")
+            rprint(f"[yellow]预算份额不足，跳过文件:[/yellow] {e}")
+            continue
+        except BudgetExhausted as e:
+            rprint(f"[bold red]Token 预算耗尽，停止生成:[/bold red] {e}")
+            break
+        finally:
+            budget.file_done()
+
+        if fp is None:
+            rprint(f"[bold red]{rel_path} 修复失败，已跳过:[/bold red] {stats.failures[rel_path]}")
+            continue
+
+        patches.append(fp)
+
+    rprint(Panel.fit(
+        json.dumps(stats.as_dict(), indent=2, ensure_ascii=False),
+        title="Repair 统计"
+    ))
+    rprint(Panel.fit(
+        json.dumps(meter.as_dict(), indent=2, ensure_ascii=False),
+        title="Token / 前缀缓存统计"
+    ))
+    rprint(Panel.fit(
+        json.dumps(get_llm(settings).stats.as_dict(), indent=2, ensure_ascii=False),
+        title="LLM Client（排队 / 重试）"
+    ))
+    rprint(Panel.fit(
+        json.dumps(budget.report(), indent=2, ensure_ascii=False),
+        title="Token 预算"
+    ))
 
-    final_patch = merge_diffs(patches)
-    if not final_patch.strip():
-        rprint("[bold red]Patch 为空，已中止[/bold red]")
+    if not patches:
+        rprint("[bold red]没有任何文件生成可用 patch，已中止[/bold red]")
         return
 
-    patch_path.write_text(final_patch, encoding="utf-8")
-    rprint(f"[bold green]Patch 已生成:[/bold green] {patch_path}")
+    # 合并后仍未通过检查时，把报错定位到单个文件，交给修复循环重新生成该文件
+    for attempt in range(settings.max_repair_attempts + 1):
+        final_patch = merge_diffs(patches)
+        if not final_patch.strip():
+            rprint("[bold red]Patch 为空，已中止[/bold red]")
+            return
+
+        patch_path.write_text(final_patch, encoding="utf-8")
+        ok, msg = apply_check(repo_root, patch_path)
+        if ok:
+            break
+
+        i = locate_merged_failure(patches, msg)
+        if i is None or attempt == settings.max_repair_attempts:
+            break
+        bad = patches.pop(i)
+        rprint(f"[yellow]合并后 {bad.rel_path} 无法应用，单独重新生成:[/yellow] {msg}")
+        try:
+            fp = generate_with_repair(
+                settings=settings,
+                repo_root=repo_root,
+                requirement=REQUIREMENT,
+                design_notes=plan.get("design_notes", []),
+                rel_path=bad.rel_path,
+                stats=stats,
+                meter=meter,
+                budget=budget,
+                focus=focus.get(bad.rel_path),
+            )
+        except BudgetExhausted as e:
+            rprint(f"[bold red]Token 预算不足，放弃 {bad.rel_path}:[/bold red] {e}")
+            fp = None
+        if fp is not None:
+            patches.insert(i, fp)
+        if not patches:
+            rprint("[bold red]没有任何文件生成可用 patch，已中止[/bold red]")
+            return
 
-    ok, msg = apply_check(repo_root, patch_path)
+    rprint(f"[bold green]Patch 已生成:[/bold green] {patch_path}")
     if ok:
         rprint("[bold green]git apply --check 通过 ✔[/bold green]")
     else:
         rprint("[bold red]git apply --check 失败 ✘[/bold red]")
         rprint(msg)
+        return
+
+    if not VERIFY_PATCH:
+        return
+
+    report = verify_patch(
+        repo_root=repo_root,
+        patch_path=patch_path,
+        head=head,
+        cache_dir=index_dir / CACHE_DIR_NAME,
+        test_timeout=settings.verify_test_timeout,
+    )
+    rprint(Panel.fit(
+        json.dumps(report.as_dict(), indent=2, ensure_ascii=False),
+        title="Patch 验证（worktree）"
+    ))
+    if report.infra_error:
+        rprint(f"[yellow]验证环境问题（结果未缓存）:[/yellow] {report.infra_error}")
+    if report.ok:
+        rprint("[bold green]编译与受影响测试通过 ✔[/bold green]")
+    else:
+        rprint("[bold red]Patch 验证失败 ✘[/bold red]")
 
 
 if __name__ == "__main__":
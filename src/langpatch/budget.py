@@ -0,0 +1,146 @@
+from __future__ import annotations
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from .config import Settings
+
+# estimate_tokens 对非 CJK 文本按 4 字符 / token 估算，任何文本都满足 字符数 <= 4 * 预估 token；
+# 因此把剩余字符预算除以 4 换算成 token，可保证满足 token 限额的 prompt 也不会超出字符预算
+CHARS_PER_TOKEN = 4
+
+
+class BudgetExhausted(Exception):
+    """
+    预算耗尽。刻意不继承 RuntimeError：
+    修复循环会吞掉 RuntimeError 继续重试，而预算耗尽必须立即中止。
+    """
+
+
+class ShareExceeded(BudgetExhausted):
+    """
+    单个文件的预算份额连 prompt 的固定部分都放不下：
+    只放弃这个文件（或它的修复），不中止整次运行，也不挤占后续文件的份额。
+    """
+
+
+@dataclass
+class TokenBudget:
+    """
+    一次运行的 token 预算，在 planner / patcher 间共享：
+    - 每次调用前用预估 token 检查并预占（reserve），调用后按真实用量记账并释放预占
+    - allowance() 给出当前调用可用的 prompt token，调用方据此降级
+    - 同时约束累计发送的 prompt 字符数（Settings.max_total_context_chars）
+    """
+    max_tokens: int
+    max_prompt_chars: int
+    reserve_completion: int = 4_000
+    used_prompt_tokens: int = 0
+    used_completion_tokens: int = 0
+    sent_prompt_chars: int = 0
+    calls: int = 0
+    reserved_tokens: int = 0
+    reserved_chars: int = 0
+    pending_files: int = 1
+    degradations: List[str] = field(default_factory=list)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @classmethod
+    def from_settings(cls, settings: Settings) -> "TokenBudget":
+        return cls(
+            max_tokens=settings.max_total_tokens,
+            max_prompt_chars=settings.max_total_context_chars,
+        )
+
+    @property
+    def used_tokens(self) -> int:
+        return self.used_prompt_tokens + self.used_completion_tokens
+
+    @property
+    def remaining_tokens(self) -> int:
+        return max(0, self.max_tokens - self.used_tokens - self.reserved_tokens)
+
+    @property
+    def remaining_chars(self) -> int:
+        return max(0, self.max_prompt_chars - self.sent_prompt_chars - self.reserved_chars)
+
+    def expect_files(self, n: int) -> None:
+        """登记还要生成 patch 的文件数，用于平均分配剩余预算"""
+        self.pending_files = max(1, n)
+
+    def file_done(self) -> None:
+        self.pending_files = max(1, self.pending_files - 1)
+
+    def allowance(self, share: float = 1.0) -> int:
+        """
+        当前这次调用可用的 prompt token，取 token 预算与字符预算中更紧的一个：
+        - token：剩余 token 按待处理文件数均分，再扣除补全预留
+        - 字符：剩余字符按待处理文件数均分，换算为 token
+        share 用于 planner 只取一部分，或在同一文件的多个并行候选间均分
+        """
+        by_tokens = int(self.remaining_tokens * share / self.pending_files) - self.reserve_completion
+        by_chars = int(self.remaining_chars * share / self.pending_files) // CHARS_PER_TOKEN
+        return max(0, min(by_tokens, by_chars))
+
+    def reserve(
+        self,
+        prompt_tokens: int,
+        prompt_chars: int,
+        what: str,
+        calls: int = 1,
+    ) -> Tuple[int, int]:
+        """
+        调用前检查并预占：calls 次调用的预估 token + 补全预留超出剩余预算则中止。
+        检查与预占在锁内完成，并行候选一次性为全部 n 次调用预占，要么都能发出要么都不发。
+        返回每次调用预占的 (tokens, chars)，每次调用结束后交给 record() 或 release() 归还
+        """
+        need = prompt_tokens + self.reserve_completion
+        with self._lock:
+            if need * calls > self.remaining_tokens:
+                raise BudgetExhausted(
+                    f"{what}: 预估需要 {need * calls} tokens，剩余 {self.remaining_tokens}"
+                )
+            if prompt_chars * calls > self.remaining_chars:
+                raise BudgetExhausted(
+                    f"{what}: prompt {prompt_chars * calls} 字符，剩余字符预算 {self.remaining_chars}"
+                )
+            self.reserved_tokens += need * calls
+            self.reserved_chars += prompt_chars * calls
+        return need, prompt_chars
+
+    def release(self, reservation: Tuple[int, int]) -> None:
+        """调用失败（没有用量可记）时归还预占"""
+        with self._lock:
+            self.reserved_tokens -= reservation[0]
+            self.reserved_chars -= reservation[1]
+
+    def record(
+        self,
+        usage: Dict[str, int],
+        prompt_chars: int,
+        reservation: Tuple[int, int] = (0, 0),
+    ) -> None:
+        """按真实用量记账，同时释放调用前的预占"""
+        with self._lock:
+            self.reserved_tokens -= reservation[0]
+            self.reserved_chars -= reservation[1]
+            self.calls += 1
+            self.used_prompt_tokens += usage.get("prompt_tokens", 0)
+            self.used_completion_tokens += usage.get("completion_tokens", 0)
+            self.sent_prompt_chars += prompt_chars
+
+    def degrade(self, note: str) -> None:
+        with self._lock:
+            self.degradations.append(note)
+
+    def report(self) -> Dict[str, object]:
+        return {
+            "max_tokens": self.max_tokens,
+            "used_prompt_tokens": self.used_prompt_tokens,
+            "used_completion_tokens": self.used_completion_tokens,
+            "remaining_tokens": self.remaining_tokens,
+            "sent_prompt_chars": self.sent_prompt_chars,
+            "max_prompt_chars": self.max_prompt_chars,
+            "calls": self.calls,
+            "degradations": list(self.degradations),
+        }
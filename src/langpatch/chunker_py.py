@@ -4,6 +4,9 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import List
 
+# 切块规则变化时递增：旧快照 / 旧索引的 chunk 与新规则不兼容
+CHUNKER_VERSION = 1
+
 
 @dataclass
 class CodeChunk:
@@ -140,3 +143,39 @@ def chunk_python_file(path: Path, text: str) -> List[CodeChunk]:
         )
 
     return chunks
+
+
+def file_outline(path: str, text: str, max_lines: int = 200) -> str:
+    """
+    文件级概要，用于粗粒度（文件级）索引：
+    - 路径 + 模块 docstring
+    - 所有类 / 函数签名及其 docstring 首行
+    语法错误时退回到文件前 40 行
+    """
+    parts: List[str] = [f"# {path}"]
+    try:
+        tree = ast.parse(text)
+    except SyntaxError:
+        return "\n".join(parts + text.splitlines()[:40])
+
+    doc = ast.get_docstring(tree)
+    if doc:
+        parts.append(doc.strip())
+
+    def walk(body: List[ast.stmt], indent: str) -> None:
+        for node in body:
+            if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                if isinstance(node, ast.ClassDef):
+                    bases = ", ".join(ast.unparse(b) for b in node.bases)
+                    sig = f"class {node.name}({bases})" if bases else f"class {node.name}"
+                else:
+                    prefix = "async def" if isinstance(node, ast.AsyncFunctionDef) else "def"
+                    sig = f"{prefix} {node.name}({ast.unparse(node.args)})"
+                d = ast.get_docstring(node)
+                first = d.strip().splitlines()[0] if d and d.strip() else ""
+                parts.append(f"{indent}{sig}" + (f"  # {first}" if first else ""))
+                if isinstance(node, ast.ClassDef):
+                    walk(node.body, indent + "    ")
+
+    walk(tree.body, "")
+    return "\n".join(parts[:max_lines])
@@ -12,18 +12,44 @@ class Settings:
     deepseek_model: str = os.getenv("DEEPSEEK_MODEL", "deepseek-coder")
 
     embed_model: str = os.getenv("EMBED_MODEL", "BAAI/bge-base-en-v1.5")
+    embed_batch_tokens: int = int(os.getenv("EMBED_BATCH_TOKENS", "16384"))  # 单批补齐后的 token 上限
+    embed_processes: int = int(os.getenv("EMBED_PROCESSES", "1"))  # >1 时启用多进程 encode 池
     index_dir: str = os.getenv("INDEX_DIR", ".langpatch_index")
+    # 分片：逗号分隔的路径前缀，或 "auto"（按顶层目录）；为空则不分片
+    index_shards: str = os.getenv("INDEX_SHARDS", "")
+
+    # llm client（进程内共享）
+    llm_timeout: float = float(os.getenv("LLM_TIMEOUT", "120"))
+    llm_max_retries: int = int(os.getenv("LLM_MAX_RETRIES", "4"))
+    llm_pool_size: int = int(os.getenv("LLM_POOL_SIZE", "10"))
+    llm_rpm: int = int(os.getenv("LLM_RPM", "0"))  # 每分钟请求数上限，0 表示不限
+    llm_tpm: int = int(os.getenv("LLM_TPM", "0"))  # 每分钟（预估）token 上限，0 表示不限
 
     # retrieval
     top_k: int = 12
+    # 两阶段检索：先选出多少个文件（0 表示关闭，使用平铺检索；>0 时索引阶段同时维护文件级概要）
+    coarse_top_files: int = int(os.getenv("COARSE_TOP_FILES", "0"))
+    # 两阶段检索时额外跑一次平铺检索，报告召回率与耗时对比
+    coarse_compare_flat: bool = os.getenv("COARSE_COMPARE_FLAT", "0") not in ("", "0", "false")
 
     # safety
     max_files_for_llm: int = 8
     max_chars_per_file: int = 120_000  # avoid huge files
+    max_file_bytes: int = int(os.getenv("MAX_FILE_BYTES", str(2_000_000)))  # stat 阶段直接跳过
     max_total_context_chars: int = 500_000
+    max_total_tokens: int = int(os.getenv("MAX_TOTAL_TOKENS", "300000"))  # 整次运行的 token 预算
+
+    # repair
+    max_repair_attempts: int = int(os.getenv("MAX_REPAIR_ATTEMPTS", "2"))
+    # 每个文件并行生成的候选 patch 数（1 表示单次生成）
+    patch_candidates: int = int(os.getenv("PATCH_CANDIDATES", "1"))
+
+    # verify
+    verify_test_timeout: int = int(os.getenv("VERIFY_TEST_TIMEOUT", "600"))
 
-def get_settings() -> Settings:
+def get_settings(require_llm: bool = True) -> Settings:
+    """require_llm=False：只建索引（CI）时不需要 LLM 密钥"""
     s = Settings()
-    if not s.deepseek_api_key:
+    if require_llm and not s.deepseek_api_key:
         raise RuntimeError("Missing DEEPSEEK_API_KEY in environment/.env")
     return s
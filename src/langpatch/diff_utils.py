@@ -1,5 +1,7 @@
 from __future__ import annotations
 import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 
 
 def looks_like_unified_diff(text: str) -> bool:
@@ -66,3 +68,119 @@ def extract_and_fix_hunks(text: str) -> str:
         return ""
 
     return "\n".join(hunks).rstrip() + "\n"
+
+
+@dataclass
+class Hunk:
+    """
+    单个 hunk 的位置信息：
+    - old_start / old_len：原文件中的起始行与行数
+    - patch_line：该 hunk 的 @@ 行在 diff 文本中的行号（从 1 开始）
+    """
+    header: str
+    old_start: int
+    old_len: int
+    patch_line: int
+    text: str
+
+
+_HUNK_RE = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+\d+(?:,\d+)? @@")
+
+
+def split_hunks(diff: str) -> List[Hunk]:
+    """
+    将单文件 diff 拆分为 hunk 列表（忽略文件头）
+    """
+    lines = diff.splitlines()
+    hunks: List[Hunk] = []
+    cur: List[str] = []
+    header = ""
+    old_start = old_len = patch_line = 0
+
+    def flush() -> None:
+        if cur:
+            hunks.append(Hunk(header, old_start, old_len, patch_line, "\n".join(cur) + "\n"))
+
+    for i, line in enumerate(lines, start=1):
+        if line.startswith("@@"):
+            flush()
+            cur = [line]
+            header = line
+            m = _HUNK_RE.match(line)
+            old_start = int(m.group(1)) if m else 0
+            old_len = int(m.group(2) or 1) if m else 0
+            patch_line = i
+            continue
+        if cur:
+            cur.append(line)
+    flush()
+    return hunks
+
+
+def parse_apply_error(message: str) -> Tuple[Optional[str], Optional[int], Optional[int]]:
+    """
+    解析 `git apply --check` 的错误输出，返回 (文件路径, 原文件行号, patch 行号)：
+    - "error: patch failed: a.py:42"      -> ("a.py", 42, None)
+    - "error: corrupt patch at line 17"   -> (None, None, 17)
+    无法识别的部分返回 None
+    """
+    path: Optional[str] = None
+    orig_line: Optional[int] = None
+    patch_line: Optional[int] = None
+
+    m = re.search(r"patch failed: (.+):(\d+)", message)
+    if m:
+        path, orig_line = m.group(1).strip(), int(m.group(2))
+    else:
+        m = re.search(r"error: (.+?): (?:patch does not apply|No such file)", message)
+        if m:
+            path = m.group(1).strip()
+
+    m = re.search(r"corrupt patch at line (\d+)", message)
+    if m:
+        patch_line = int(m.group(1))
+
+    return path, orig_line, patch_line
+
+
+_HEADER_ERROR_RE = re.compile(
+    r"No such file or directory"
+    r"|already exists in (?:working directory|index)"
+    r"|does not exist in index"
+    r"|new file .+ depends on old contents"
+)
+
+
+def is_header_error(message: str) -> bool:
+    """
+    `git apply --check` 的错误是否出在文件头（文件存在与否）而非某个 hunk：
+    文件头由本地拼接而非模型生成，这类错误重新请求模型无法修复
+    """
+    return bool(_HEADER_ERROR_RE.search(message))
+
+
+def locate_failed_hunk(diff: str, message: str) -> Optional[Hunk]:
+    """
+    根据 git 错误信息定位出错的 hunk；无法定位时返回 None
+    """
+    hunks = split_hunks(diff)
+    if not hunks:
+        return None
+
+    _, orig_line, patch_line = parse_apply_error(message)
+
+    if patch_line is not None:
+        found = None
+        for h in hunks:
+            if h.patch_line <= patch_line:
+                found = h
+        return found or hunks[0]
+
+    if orig_line is not None:
+        for h in hunks:
+            if h.old_start == orig_line:
+                return h
+        # git 报告的是 hunk 起始行；偏移时取最近的一个
+        return min(hunks, key=lambda h: abs(h.old_start - orig_line))
+
+    return None
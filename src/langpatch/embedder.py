@@ -0,0 +1,149 @@
+from __future__ import annotations
+import os
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+from sentence_transformers import SentenceTransformer
+
+
+@dataclass
+class EmbedStats:
+    """
+    embedding 调度统计：
+    - padding_waste：批内补齐产生的无效 token 占比
+    """
+    chunks: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+    real_tokens: int = 0
+    padded_tokens: int = 0
+    processes: int = 1
+
+    @property
+    def chunks_per_sec(self) -> float:
+        return self.chunks / self.seconds if self.seconds else 0.0
+
+    @property
+    def padding_waste(self) -> float:
+        return 1 - self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "chunks": self.chunks,
+            "batches": self.batches,
+            "seconds": round(self.seconds, 2),
+            "chunks_per_sec": round(self.chunks_per_sec, 1),
+            "padding_waste": round(self.padding_waste, 3),
+            "processes": self.processes,
+        }
+
+
+def token_lengths(model: SentenceTransformer, texts: List[str]) -> List[int]:
+    """用模型自己的 tokenizer 计算长度（按 max_seq_length 截断）"""
+    enc = model.tokenizer(
+        texts,
+        add_special_tokens=True,
+        truncation=True,
+        max_length=model.max_seq_length,
+    )
+    return [len(ids) for ids in enc["input_ids"]]
+
+
+def plan_batches(
+    lengths: List[int],
+    batch_tokens: int,
+    max_batch_size: int,
+) -> List[List[int]]:
+    """
+    按长度降序分桶，批大小由「批内最长 * 条数 <= batch_tokens」决定：
+    长文本小批、短文本大批，显存 / 内存占用大致恒定，补齐浪费最小
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i], reverse=True)
+    batches: List[List[int]] = []
+    i = 0
+    while i < len(order):
+        longest = max(1, lengths[order[i]])
+        size = max(1, min(max_batch_size, batch_tokens // longest))
+        batches.append(order[i:i + size])
+        i += size
+    return batches
+
+
+def _start_pool(model: SentenceTransformer, processes: int) -> dict:
+    """
+    启动多进程 encode 池：每个进程分到 cpu_count / processes 个线程，
+    避免多个进程的 intra-op 线程互相争抢
+    """
+    threads = max(1, (os.cpu_count() or 1) // processes)
+    saved = os.environ.get("OMP_NUM_THREADS")
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    try:
+        return model.start_multi_process_pool(target_devices=["cpu"] * processes)
+    finally:
+        if saved is None:
+            os.environ.pop("OMP_NUM_THREADS", None)
+        else:
+            os.environ["OMP_NUM_THREADS"] = saved
+
+
+def embed_texts(
+    model: SentenceTransformer,
+    texts: List[str],
+    batch_tokens: int = 16_384,
+    max_batch_size: int = 128,
+    processes: int = 1,
+    stats: Optional[EmbedStats] = None,
+) -> np.ndarray:
+    """
+    按长度分桶批量 encode，返回与 texts 顺序一致的归一化向量矩阵。
+    processes > 1 且数据量足够时使用 sentence-transformers 的多进程池。
+    """
+    stats = stats if stats is not None else EmbedStats()
+    if not texts:
+        return np.zeros((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+
+    t0 = time.perf_counter()
+    lengths = token_lengths(model, texts)
+    batches = plan_batches(lengths, batch_tokens, max_batch_size)
+
+    use_pool = processes > 1 and len(texts) >= processes * max_batch_size
+    pool = _start_pool(model, processes) if use_pool else None
+
+    out: Optional[np.ndarray] = None
+    try:
+        # encode 会在输入内部重新按字符长度排序再切批，合并多个计划批会改变批次划分：
+        # - 单进程：每个计划批单独 encode，实际批次与计划一致
+        # - 多进程池：连续且大小相同的批合并为一次调用，chunk_size 等于批大小，
+        #   池按顺序切块，每块恰好是一个计划批，在子进程中作为单独一批 encode
+        i = 0
+        while i < len(batches):
+            j = i
+            while pool and j + 1 < len(batches) and len(batches[j + 1]) == len(batches[i]):
+                j += 1
+            idx = [k for b in batches[i:j + 1] for k in b]
+            kwargs = {"pool": pool, "chunk_size": len(batches[i])} if pool else {}
+            embs = np.asarray(model.encode(
+                [texts[k] for k in idx],
+                batch_size=len(batches[i]),
+                normalize_embeddings=True,
+                **kwargs,
+            ))
+            if out is None:
+                out = np.zeros((len(texts), embs.shape[1]), dtype=embs.dtype)
+            out[idx] = embs
+
+            for b in batches[i:j + 1]:
+                stats.padded_tokens += max(lengths[k] for k in b) * len(b)
+                stats.real_tokens += sum(lengths[k] for k in b)
+            i = j + 1
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+    stats.chunks += len(texts)
+    stats.batches += len(batches)
+    stats.seconds += time.perf_counter() - t0
+    stats.processes = processes if use_pool else 1
+    return out
@@ -1,8 +1,13 @@
 from __future__ import annotations
 
+import codecs
+import os
+import stat
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict, dataclass
 from pathlib import Path
-from typing import Iterable, List
+from typing import Dict, Iterable, List, Optional
 
 DEFAULT_EXCLUDES = {
     ".git", "node_modules", "venv", ".venv", "__pycache__", "dist", "build",
@@ -27,22 +32,125 @@ def is_excluded(path: Path, repo_root: Path, excludes: set[str]) -> bool:
     return False
 
 
-def read_text_safely(path: Path, max_chars: int) -> str:
-    data = path.read_bytes()
-    # naive utf-8 decode fallback
+BINARY_SNIFF_BYTES = 8192
+READ_BLOCK_BYTES = 64 * 1024
+
+# 常见文本控制字符之外的字节（\t \n \r \f \b \x1b 之外的 < 0x20）
+_TEXT_CONTROL = bytes({7, 8, 9, 10, 12, 13, 27})
+
+
+@dataclass
+class IngestStats:
+    """
+    文件读取统计：
+    - bytes_read：实际从磁盘读取的字节
+    - bytes_skipped：因二进制 / 超过大小上限 / 截断而未读取的字节
+    """
+    files_read: int = 0
+    files_binary: int = 0
+    files_too_large: int = 0
+    files_missing: int = 0
+    bytes_read: int = 0
+    bytes_skipped: int = 0
+
+    def as_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+
+def looks_binary(head: bytes) -> bool:
+    """
+    根据文件开头的字节判断是否为二进制：
+    - 含 NUL 字节
+    - 或非文本控制字符占比超过 30%
+    """
+    if not head:
+        return False
+    if b"\x00" in head:
+        return True
+    ctrl = sum(1 for b in head if b < 0x20 and b not in _TEXT_CONTROL)
+    return ctrl / len(head) > 0.3
+
+
+def read_text_safely(
+    path: Path,
+    max_chars: int,
+    max_bytes: Optional[int] = None,
+    stats: Optional[IngestStats] = None,
+) -> str:
+    """
+    流式读取文本文件：
+    - 先 fstat，超过 max_bytes 的文件直接跳过（返回空串）
+    - 嗅探开头字节，二进制文件跳过
+    - 按块增量解码，读够 max_chars 个字符即停止，不读整个文件
+    """
+    stats = stats if stats is not None else IngestStats()
     try:
-        text = data.decode("utf-8")
-    except UnicodeDecodeError:
-        text = data.decode("utf-8", errors="ignore")
+        fh = path.open("rb")
+    except OSError:
+        stats.files_missing += 1
+        return ""
+
+    with fh:
+        size = os.fstat(fh.fileno()).st_size
+        if max_bytes is not None and size > max_bytes:
+            stats.files_too_large += 1
+            stats.bytes_skipped += size
+            return ""
+
+        head = fh.read(BINARY_SNIFF_BYTES)
+        read = len(head)
+        if looks_binary(head):
+            stats.files_binary += 1
+            stats.bytes_read += read
+            stats.bytes_skipped += max(size - read, 0)
+            return ""
+
+        # naive utf-8 decode fallback：非法字节直接忽略
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        parts: List[str] = [decoder.decode(head)]
+        n = len(parts[0])
+        while n <= max_chars:
+            block = fh.read(READ_BLOCK_BYTES)
+            if not block:
+                parts.append(decoder.decode(b"", final=True))
+                break
+            read += len(block)
+            part = decoder.decode(block)
+            parts.append(part)
+            n += len(part)
+
+    stats.files_read += 1
+    stats.bytes_read += read
+    stats.bytes_skipped += max(size - read, 0)
+
+    text = "".join(parts)
     if len(text) > max_chars:
         return text[:max_chars] + "\n\n# [TRUNCATED]\n"
     return text
 
 
+def stat_files(paths: List[Path], workers: int = 16) -> List[Optional[os.stat_result]]:
+    """
+    并发 stat 一批文件（网络盘 / 大仓库下比串行快很多），不存在的返回 None
+    """
+    def _stat(p: Path) -> Optional[os.stat_result]:
+        try:
+            return p.stat()
+        except OSError:
+            return None
+
+    if len(paths) < 2 * workers:
+        return [_stat(p) for p in paths]
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(_stat, paths, chunksize=64))
+
+
 def filter_files(
     files: Iterable[Path],
     repo_root: Path,
     excludes: set[str],
+    max_bytes: Optional[int] = None,
+    stats: Optional[IngestStats] = None,
 ) -> List[Path]:
     """
     过滤文件列表。
@@ -50,12 +158,19 @@ def filter_files(
     约定：
     - files 必须是 Path 对象
     - 返回值是存在于 repo_root 下的 Path
+    - 给定 max_bytes 时，按 stat 结果直接剔除超大文件
     """
+    stats = stats if stats is not None else IngestStats()
+    candidates = [p for p in files if not is_excluded(p, repo_root, excludes)]
+
     out: List[Path] = []
-    for p in files:
-        if not p.exists():
+    for p, st in zip(candidates, stat_files(candidates)):
+        if st is None or not stat.S_ISREG(st.st_mode):
+            stats.files_missing += 1
             continue
-        if is_excluded(p, repo_root, excludes):
+        if max_bytes is not None and st.st_size > max_bytes:
+            stats.files_too_large += 1
+            stats.bytes_skipped += st.st_size
             continue
         out.append(p)
     return out
@@ -29,3 +29,41 @@ def apply_check(repo: Path, patch_path: Path) -> Tuple[bool, str]:
     if p.returncode == 0:
         return True, "OK"
     return False, (p.stderr.strip() or p.stdout.strip() or "git apply --check failed")
+
+def apply_check_text(repo: Path, diff: str) -> Tuple[bool, str]:
+    """对内存中的 diff 文本执行 `git apply --check`（经 stdin 传入，不落盘）"""
+    p = subprocess.run(
+        ["git", "apply", "--check", "-"],
+        cwd=str(repo),
+        input=diff,
+        capture_output=True,
+        text=True,
+    )
+    if p.returncode == 0:
+        return True, "OK"
+    return False, (p.stderr.strip() or p.stdout.strip() or "git apply --check failed")
+
+def dirty_files(repo: Path, paths: List[str]) -> List[str]:
+    """paths 中相对 HEAD 有未提交改动（含未跟踪）的文件"""
+    if not paths:
+        return []
+    out = run(["git", "status", "--porcelain", "--", *paths], repo)
+    return [line.split(maxsplit=1)[-1] for line in out.splitlines() if line.strip()]
+
+def add_worktree(repo: Path, path: Path, rev: str = "HEAD") -> None:
+    """在 path 处创建指向 rev 的临时 worktree（detached，不产生分支）"""
+    run(["git", "worktree", "add", "--detach", str(path), rev], repo)
+
+def remove_worktree(repo: Path, path: Path) -> None:
+    run(["git", "worktree", "remove", "--force", str(path)], repo)
+
+def apply_patch(repo: Path, patch_path: Path) -> Tuple[bool, str]:
+    p = subprocess.run(
+        ["git", "apply", str(patch_path)],
+        cwd=str(repo),
+        capture_output=True,
+        text=True,
+    )
+    if p.returncode == 0:
+        return True, "OK"
+    return False, (p.stderr.strip() or p.stdout.strip() or "git apply failed")
@@ -1,19 +1,29 @@
 from __future__ import annotations
 import json
 import hashlib
+import re
+from dataclasses import asdict, dataclass, field
 from pathlib import Path
-from typing import Dict, List, Tuple
+from typing import Dict, List, Optional, Sequence, Tuple
 
 import chromadb
 from chromadb.config import Settings as ChromaSettings
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
-from .chunker_py import chunk_python_file, CodeChunk
-from .fs_utils import read_text_safely
+from .chunker_py import chunk_python_file, file_outline, CodeChunk
+from .embedder import EmbedStats, embed_texts
+from .fs_utils import IngestStats, read_text_safely
 
 HASH_FILE = "file_hashes.json"
+# 2：所有路径（hash 表 key、chunk id、file_path）改为 repo 相对的 posix 路径
+# 3：metadata 增加各级目录前缀（dir1 / dir2 / ...），检索范围在查询内过滤
+INDEX_FORMAT = 3
 COLLECTION_NAME = "code_chunks"
+# 粗粒度索引：每个文件一条（路径 + docstring + 签名概要），用于两阶段检索
+FILES_COLLECTION_NAME = "code_files"
+SHARD_META_KEY = "shard_prefix"
+AUTO_SHARD = "auto"
 
 def _sha1(text: str) -> str:
     return hashlib.sha1(text.encode("utf-8")).hexdigest()
@@ -25,95 +35,371 @@ def get_chroma_client(index_dir: Path) -> chromadb.Client:
         settings=ChromaSettings(anonymized_telemetry=False),
     )
 
-def get_collection(client: chromadb.Client) -> chromadb.Collection:
-    try:
-        return client.get_collection(COLLECTION_NAME)
-    except Exception:
-        return client.create_collection(COLLECTION_NAME)
+def parse_shard_prefixes(spec: str) -> Tuple[str, ...]:
+    """
+    解析分片配置（逗号分隔的路径前缀）：
+    - 空：不分片，所有 chunk 放在默认 collection
+    - "auto"：按顶层目录自动分片
+    - 其他：按给定路径前缀分片（最长前缀匹配），未命中的进入默认分片
+    """
+    return tuple(p.strip().strip("/") for p in spec.split(",") if p.strip().strip("/"))
 
-def load_hashes(index_dir: Path) -> Dict[str, str]:
+def shard_of(rel_path: str, prefixes: Sequence[str]) -> str:
+    """返回文件所属分片的路径前缀；"" 表示默认分片"""
+    rel = Path(rel_path).as_posix()
+    best = ""
+    for p in prefixes:
+        if p != AUTO_SHARD and (rel == p or rel.startswith(p + "/")) and len(p) > len(best):
+            best = p
+    if not best and AUTO_SHARD in prefixes and "/" in rel:
+        best = rel.split("/", 1)[0]
+    return best
+
+def collection_name(shard: str) -> str:
+    """
+    分片对应的 Chroma collection 名（只允许 [a-zA-Z0-9._-]，长度 <= 63）
+    """
+    if not shard:
+        return COLLECTION_NAME
+    safe = re.sub(r"[^a-zA-Z0-9._-]+", "_", shard).strip("._-") or "shard"
+    name = f"{COLLECTION_NAME}__{safe}"
+    if len(name) > 63:
+        name = f"{name[:50]}_{_sha1(shard)[:8]}"
+    return name
+
+def get_collection(client: chromadb.Client, shard: str = "") -> chromadb.Collection:
+    return client.get_or_create_collection(
+        collection_name(shard),
+        metadata={SHARD_META_KEY: shard},
+    )
+
+def get_files_collection(client: chromadb.Client) -> chromadb.Collection:
+    return client.get_or_create_collection(FILES_COLLECTION_NAME)
+
+def list_shards(client: chromadb.Client) -> Dict[str, chromadb.Collection]:
+    """列出索引中已有的所有分片：{路径前缀: collection}"""
+    out: Dict[str, chromadb.Collection] = {}
+    for c in client.list_collections():
+        col = c if hasattr(c, "query") else client.get_collection(c)
+        if col.name != COLLECTION_NAME and not col.name.startswith(COLLECTION_NAME + "__"):
+            continue
+        out[(col.metadata or {}).get(SHARD_META_KEY, "")] = col
+    return out
+
+def rel_key(path: Path, repo_root: Path) -> str:
+    """索引中统一使用的路径形式：repo 相对、posix 分隔符（跨机器 / 跨系统可移植）"""
+    return path.relative_to(repo_root).as_posix()
+
+def _read_hash_file(index_dir: Path) -> Optional[dict]:
     p = index_dir / HASH_FILE
     if not p.exists():
-        return {}
+        return None
     try:
         return json.loads(p.read_text(encoding="utf-8"))
     except Exception:
         return {}
 
-def save_hashes(index_dir: Path, hashes: Dict[str, str]) -> None:
+def is_legacy_index(index_dir: Path) -> bool:
+    """旧格式索引（绝对路径）需要整体重建"""
+    data = _read_hash_file(index_dir)
+    return data is not None and data.get("format") != INDEX_FORMAT
+
+def load_hashes(index_dir: Path) -> Dict[str, str]:
+    data = _read_hash_file(index_dir) or {}
+    if data.get("format") != INDEX_FORMAT:
+        return {}
+    return dict(data.get("files") or {})
+
+def load_shard_spec(index_dir: Path) -> Tuple[str, ...]:
+    """索引构建时使用的分片配置（未记录视为不分片）"""
+    data = _read_hash_file(index_dir) or {}
+    return tuple(data.get("shards") or ())
+
+def shard_spec_changed(index_dir: Path, shard_prefixes: Sequence[str]) -> bool:
+    """
+    分片配置变化后，文件 hash 不变也无法把 chunk 迁移到新分片，
+    而被编辑的文件旧 chunk 会留在原分片中成为重复结果，因此需要整体重建
+    """
+    if not load_hashes(index_dir):
+        return False
+    return sorted(load_shard_spec(index_dir)) != sorted(shard_prefixes)
+
+def save_hashes(index_dir: Path, hashes: Dict[str, str], shards: Sequence[str] = ()) -> None:
     p = index_dir / HASH_FILE
-    p.write_text(json.dumps(hashes, indent=2, ensure_ascii=False), encoding="utf-8")
+    data = {"format": INDEX_FORMAT, "shards": sorted(shards), "files": hashes}
+    p.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+
+def drop_all_shards(client: chromadb.Client) -> None:
+    for col in list_shards(client).values():
+        client.delete_collection(col.name)
+    try:
+        client.delete_collection(FILES_COLLECTION_NAME)
+    except Exception:
+        pass
+
+def chunk_id(c: CodeChunk, chunk_hash: str, seq: int = 0) -> str:
+    """
+    chunk id 由「文件 + 符号 + 内容 hash」组成，不含行号：
+    只发生行号平移的 chunk 保持同一个 id，只需更新 metadata
+    """
+    cid = f"{c.file_path}:{c.symbol}:{chunk_hash[:16]}"
+    return f"{cid}#{seq}" if seq else cid
+
+def dir_key(depth: int) -> str:
+    """第 depth 级目录前缀的 metadata key（dir1 = 顶层目录）"""
+    return f"dir{depth}"
+
+def dir_meta(rel_path: str) -> dict:
+    """
+    文件所在各级目录前缀：a/b/c.py -> {"dir1": "a", "dir2": "a/b"}
+    Chroma 的 where 不支持前缀匹配，检索范围（SCOPE_PATHS）据此按等值过滤
+    """
+    parts = rel_path.split("/")[:-1]
+    return {dir_key(i): "/".join(parts[:i]) for i in range(1, len(parts) + 1)}
+
+def chunk_meta(c: CodeChunk, chunk_hash: str) -> dict:
+    # file_path 已是 repo 相对路径；rel_path 保留给检索 / planner 使用
+    return {
+        "file_path": c.file_path,
+        "symbol": c.symbol,
+        "start_line": c.start_line,
+        "end_line": c.end_line,
+        "rel_path": c.file_path,
+        "chunk_hash": chunk_hash,
+        "snippet": c.text,
+        **dir_meta(c.file_path),
+    }
+
+@dataclass
+class IndexStats:
+    """
+    一次增量索引的统计：
+    - embedded：内容变化、需要重新 embedding 的 chunk
+    - moved：内容未变、仅行号变化（只更新 metadata）
+    - unchanged：所在文件变了，但 chunk 本身完全没变
+    - deleted：已不存在的旧 chunk
+    - rebuilt：索引格式或分片配置变化，已整体重建
+    """
+    files_scanned: int = 0
+    files_changed: int = 0
+    embedded: int = 0
+    moved: int = 0
+    unchanged: int = 0
+    deleted: int = 0
+    shard_sizes: Dict[str, int] = field(default_factory=dict)
+    embedding: Dict[str, object] = field(default_factory=dict)
+    outlines_embedded: int = 0
+    outlines_deleted: int = 0
+    rebuilt: bool = False
+
+    def as_dict(self) -> Dict[str, int]:
+        return asdict(self)
+
+def _diff_file_chunks(
+    col: chromadb.Collection,
+    file_path: str,
+    chunks: List[CodeChunk],
+    stats: IndexStats,
+) -> Tuple[List[str], List[str], List[dict], List[str], List[dict], List[str]]:
+    """
+    将文件的新 chunk 与索引中已有的 chunk 按 id（含内容 hash）对比，返回：
+    (待 embedding 的 ids/docs/metas, 仅需更新 metadata 的 ids/metas, 待删除的 ids)
+    """
+    old = col.get(where={"file_path": file_path}, include=["metadatas"])
+    old_meta = dict(zip(old["ids"], old["metadatas"]))
+
+    add_ids: List[str] = []
+    add_docs: List[str] = []
+    add_metas: List[dict] = []
+    upd_ids: List[str] = []
+    upd_metas: List[dict] = []
+
+    seen: Dict[str, int] = {}
+    for c in chunks:
+        h = _sha1(c.text)
+        base = chunk_id(c, h)
+        seq = seen.get(base, 0)
+        seen[base] = seq + 1
+        cid = chunk_id(c, h, seq)
+        meta = chunk_meta(c, h)
+
+        prev = old_meta.pop(cid, None)
+        if prev is None:
+            add_ids.append(cid)
+            add_docs.append(c.text)
+            add_metas.append(meta)
+        elif (prev.get("start_line"), prev.get("end_line")) != (c.start_line, c.end_line):
+            upd_ids.append(cid)
+            upd_metas.append(meta)
+            stats.moved += 1
+        else:
+            stats.unchanged += 1
+
+    # 剩下的旧 chunk（包括旧版按行号命名的 id）都已失效
+    del_ids = list(old_meta.keys())
+    stats.deleted += len(del_ids)
+    return add_ids, add_docs, add_metas, upd_ids, upd_metas, del_ids
+
+@dataclass
+class _ShardBatch:
+    add_ids: List[str] = field(default_factory=list)
+    add_docs: List[str] = field(default_factory=list)
+    add_metas: List[dict] = field(default_factory=list)
+    upd_ids: List[str] = field(default_factory=list)
+    upd_metas: List[dict] = field(default_factory=list)
+    del_ids: List[str] = field(default_factory=list)
 
 def build_or_update_index(
     repo_root: Path,
     index_dir: Path,
     files: List[Path],
     embed_model: str,
-    batch_size: int = 32,
+    batch_size: int = 128,
     max_chars_per_file: int = 80_000,
-) -> None:
+    max_file_bytes: Optional[int] = None,
+    ingest: Optional[IngestStats] = None,
+    shard_prefixes: Sequence[str] = (),
+    only_shards: Optional[Sequence[str]] = None,
+    batch_tokens: int = 16_384,
+    embed_processes: int = 1,
+    coarse: bool = False,
+) -> IndexStats:
+    """
+    增量构建索引：
+    - 文件级 hash 未变：整文件跳过
+    - 文件变化：重新切块，只对内容变化的 chunk 做 embedding，
+      行号平移的 chunk 只更新 metadata，消失的 chunk 被删除
+    - 按 shard_prefixes 分片写入各自的 collection；
+      给定 only_shards 时只处理这些分片的文件，其余分片不受影响
+    - 所有分片待 embedding 的 chunk 一起交给 embed_texts 按长度分桶调度
+      （batch_size 为单批上限，batch_tokens 为单批补齐后的 token 上限）
+    - coarse=True 时同时维护文件级概要索引（缺失的文件会被补齐，
+      已删除 / 重命名的文件从概要索引中移除；给定 only_shards 时只清理这些分片）
+    - 分片配置与 hash 表中记录的不一致时整体重建（与旧格式索引相同）
+    """
     client = get_chroma_client(index_dir)
-    col = get_collection(client)
+    stats = IndexStats()
+    if is_legacy_index(index_dir) or shard_spec_changed(index_dir, shard_prefixes):
+        drop_all_shards(client)
+        stats.rebuilt = True
+    cols: Dict[str, chromadb.Collection] = {}
+    batches: Dict[str, _ShardBatch] = {}
 
-    model = SentenceTransformer(embed_model, device="cpu")
-    hashes = load_hashes(index_dir)
+    hashes = {} if stats.rebuilt else load_hashes(index_dir)
 
-    ids: List[str] = []
-    docs: List[str] = []
-    metas: List[dict] = []
+    files_col: Optional[chromadb.Collection] = None
+    have_outline: Dict[str, str] = {}  # rel -> shard
+    outlines: List[Tuple[str, str, str]] = []  # (rel, shard, outline)
+    if coarse:
+        files_col = get_files_collection(client)
+        res = files_col.get(include=["metadatas"])
+        have_outline = {
+            i: (m or {}).get("shard", "") for i, m in zip(res["ids"], res["metadatas"])
+        }
 
     for f in tqdm(files, desc="Indexing"):
-        text = read_text_safely(f, max_chars=max_chars_per_file)
+        rel = rel_key(f, repo_root)
+        shard = shard_of(rel, shard_prefixes)
+        if only_shards is not None and shard not in only_shards:
+            continue
+
+        text = read_text_safely(
+            f, max_chars=max_chars_per_file, max_bytes=max_file_bytes, stats=ingest
+        )
         if not text:
             continue
 
-        rel = str(f.relative_to(repo_root))
+        stats.files_scanned += 1
         h = _sha1(text)
-        if hashes.get(str(f)) == h:
+        if coarse and (hashes.get(rel) != h or rel not in have_outline):
+            outlines.append((rel, shard, file_outline(rel, text)))
+        if hashes.get(rel) == h:
             continue
 
-        chunks: List[CodeChunk] = chunk_python_file(str(f), text)
-
-        # Delete old chunks for this file (by prefix match)
-        # (Chroma doesn't support prefix delete directly; we just overwrite via new ids)
-        # Note: If duplicates remain, it doesn't break retrieval but wastes space.
-
-        for c in chunks:
-            cid = f"{c.file_path}:{c.symbol}:{c.start_line}-{c.end_line}"
-            ids.append(cid)
-            docs.append(c.text)
-            metas.append({
-                "file_path": c.file_path,
-                "symbol": c.symbol,
-                "start_line": c.start_line,
-                "end_line": c.end_line,
-                "rel_path": str(Path(c.file_path).relative_to(repo_root)),
-                "snippet": c.text,
-            })
-
-        hashes[str(f)] = _sha1(text)
-
-    if not ids:
-        # nothing to add
-        save_hashes(index_dir, hashes)
-        return
-
-    # upsert by adding; duplicates may occur if ids collide, but ids are stable per file+symbol+range
-    # chroma will error if duplicate ids exist; so delete then add if needed.
-    # here we attempt delete existing ids first.
-    try:
-        col.delete(ids=ids)
-    except Exception:
-        pass
+        stats.files_changed += 1
+        chunks: List[CodeChunk] = chunk_python_file(rel, text)
+
+        if shard not in cols:
+            cols[shard] = get_collection(client, shard)
+            batches[shard] = _ShardBatch()
+        b = batches[shard]
+
+        a_ids, a_docs, a_metas, u_ids, u_metas, d_ids = _diff_file_chunks(
+            cols[shard], rel, chunks, stats
+        )
+        b.add_ids += a_ids
+        b.add_docs += a_docs
+        b.add_metas += a_metas
+        b.upd_ids += u_ids
+        b.upd_metas += u_metas
+        b.del_ids += d_ids
+
+        hashes[rel] = h
 
-    for i in range(0, len(ids), batch_size):
-        batch_docs = docs[i:i+batch_size]
-        embs = model.encode(batch_docs, normalize_embeddings=True).tolist()
-        col.add(
-            ids=ids[i:i+batch_size],
-            documents=batch_docs,
-            metadatas=metas[i:i+batch_size],
-            embeddings=embs,
+    all_docs = [d for b in batches.values() for d in b.add_docs]
+    n_chunk_docs = len(all_docs)
+    all_docs += [o for _, _, o in outlines]
+    embs = None
+    if all_docs:
+        embed_stats = EmbedStats()
+        model = SentenceTransformer(embed_model, device="cpu")
+        embs = embed_texts(
+            model,
+            all_docs,
+            batch_tokens=batch_tokens,
+            max_batch_size=batch_size,
+            processes=embed_processes,
+            stats=embed_stats,
         )
+        stats.embedding = embed_stats.as_dict()
+
+    offset = 0
+    for shard, b in batches.items():
+        col = cols[shard]
+        if b.del_ids:
+            col.delete(ids=b.del_ids)
+
+        if b.upd_ids:
+            col.update(ids=b.upd_ids, metadatas=b.upd_metas)
+
+        if b.add_ids:
+            # embed_texts 已恢复原始顺序，按分片切回
+            shard_embs = embs[offset:offset + len(b.add_ids)]
+            offset += len(b.add_ids)
+            for i in range(0, len(b.add_ids), batch_size):
+                col.upsert(
+                    ids=b.add_ids[i:i+batch_size],
+                    documents=b.add_docs[i:i+batch_size],
+                    metadatas=b.add_metas[i:i+batch_size],
+                    embeddings=shard_embs[i:i+batch_size].tolist(),
+                )
+            stats.embedded += len(b.add_ids)
+
+    if files_col is not None:
+        current = {rel_key(f, repo_root) for f in files}
+        stale = [
+            rel for rel, shard in have_outline.items()
+            if rel not in current and (only_shards is None or shard in only_shards)
+        ]
+        for i in range(0, len(stale), batch_size):
+            files_col.delete(ids=stale[i:i+batch_size])
+        stats.outlines_deleted = len(stale)
+
+    if files_col is not None and outlines:
+        out_embs = embs[n_chunk_docs:]
+        for i in range(0, len(outlines), batch_size):
+            part = outlines[i:i+batch_size]
+            files_col.upsert(
+                ids=[rel for rel, _, _ in part],
+                documents=[o for _, _, o in part],
+                metadatas=[
+                    {"rel_path": rel, "shard": shard, **dir_meta(rel)} for rel, shard, _ in part
+                ],
+                embeddings=out_embs[i:i+batch_size].tolist(),
+            )
+        stats.outlines_embedded = len(outlines)
+
+    stats.shard_sizes = {s or "(default)": c.count() for s, c in list_shards(client).items()}
 
-    save_hashes(index_dir, hashes)
+    save_hashes(index_dir, hashes, shard_prefixes)
+    return stats
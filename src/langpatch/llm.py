@@ -1,11 +1,246 @@
 from __future__ import annotations
-from .config import Settings
+import random
+import re
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Any, Dict, List, Optional
+
+import httpx
+import openai
+from langchain_core.messages import BaseMessage
 from langchain_openai import ChatOpenAI
 
-def get_llm(settings: Settings) -> ChatOpenAI:
-    return ChatOpenAI(
-        model=settings.deepseek_model,
-        base_url=settings.deepseek_base_url,
-        api_key=settings.deepseek_api_key,
-        temperature=0,
-    )
+from .config import Settings
+
+_CJK_RE = re.compile(r"[\u3000-\u9fff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估算 token 数：中日韩字符约 1 token / 字，其余约 4 字符 / token
+    """
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk) // 4 + 1
+
+
+class TokenBucket:
+    """
+    令牌桶限流：容量为每分钟上限，按秒匀速补充。
+    rate_per_min <= 0 表示不限流。
+    """
+
+    def __init__(self, rate_per_min: int) -> None:
+        self.capacity = float(rate_per_min)
+        self.rate = rate_per_min / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, n: float = 1.0) -> float:
+        """阻塞直到取得 n 个令牌，返回排队等待的秒数"""
+        if self.capacity <= 0:
+            return 0.0
+        n = min(n, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return waited
+                delay = (n - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def adjust(self, n: float) -> None:
+        """按实际用量补扣（n 为正表示多扣，允许欠账，后续请求会因此排队）"""
+        if self.capacity <= 0:
+            return
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - n)
+
+
+@dataclass
+class ClientStats:
+    """共享 LLM client 的调用统计"""
+    requests: int = 0
+    retries: int = 0
+    failures: int = 0
+    queue_wait_s: float = 0.0
+
+    def as_dict(self) -> Dict[str, object]:
+        d = asdict(self)
+        d["queue_wait_s"] = round(self.queue_wait_s, 3)
+        return d
+
+
+def _is_retryable(e: Exception) -> bool:
+    if isinstance(e, (openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    if isinstance(e, openai.APIStatusError):
+        return e.status_code == 429 or e.status_code >= 500
+    return False
+
+
+def _retry_after(e: Exception) -> Optional[float]:
+    resp = getattr(e, "response", None)
+    value = resp.headers.get("retry-after") if resp is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class PooledLLM:
+    """
+    进程内共享的 LLM client：
+    - 复用同一个 httpx 连接池（keep-alive），显式超时
+    - 429 / 5xx / 连接错误按带抖动的指数退避重试（优先遵循 Retry-After）
+    - 按「请求数 / 预估 token 数」两个令牌桶限流
+    接口与 ChatOpenAI.invoke 保持一致，planner / patcher 无需感知。
+    """
+
+    def __init__(self, settings: Settings) -> None:
+        self.settings = settings
+        self.http_client = httpx.Client(
+            timeout=httpx.Timeout(settings.llm_timeout, connect=10.0),
+            limits=httpx.Limits(
+                max_connections=settings.llm_pool_size,
+                max_keepalive_connections=settings.llm_pool_size,
+            ),
+        )
+        self.chat = ChatOpenAI(
+            model=settings.deepseek_model,
+            base_url=settings.deepseek_base_url,
+            api_key=settings.deepseek_api_key,
+            temperature=0,
+            timeout=settings.llm_timeout,
+            max_retries=0,  # 由本类统一重试，避免与 SDK 内部重试叠加
+            http_client=self.http_client,
+        )
+        self.requests = TokenBucket(settings.llm_rpm)
+        self.tokens = TokenBucket(settings.llm_tpm)
+        self.stats = ClientStats()
+        self._lock = threading.Lock()
+
+    def invoke(self, messages: List[BaseMessage], **kwargs: Any) -> Any:
+        """
+        kwargs 透传给模型（例如 temperature），通过 bind 生效
+        """
+        estimate = sum(estimate_tokens(str(m.content)) for m in messages)
+        runnable = self.chat.bind(**kwargs) if kwargs else self.chat
+
+        attempt = 0
+        while True:
+            waited = self.requests.acquire(1) + self.tokens.acquire(estimate)
+            with self._lock:
+                self.stats.requests += 1
+                self.stats.queue_wait_s += waited
+            try:
+                resp = runnable.invoke(messages)
+            except Exception as e:
+                if not _is_retryable(e) or attempt >= self.settings.llm_max_retries:
+                    with self._lock:
+                        self.stats.failures += 1
+                    raise
+                delay = _retry_after(e)
+                if delay is None:
+                    delay = min(30.0, 2 ** attempt) * (0.5 + random.random())
+                attempt += 1
+                with self._lock:
+                    self.stats.retries += 1
+                time.sleep(delay)
+                continue
+
+            usage = get_usage(resp)
+            actual = usage["prompt_tokens"] + usage["completion_tokens"]
+            if actual:
+                self.tokens.adjust(actual - estimate)
+            return resp
+
+
+_CLIENTS: Dict[Settings, PooledLLM] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def get_llm(settings: Settings) -> PooledLLM:
+    """返回进程内共享的 client（同一份 Settings 只创建一次）"""
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(settings)
+        if client is None:
+            client = _CLIENTS[settings] = PooledLLM(settings)
+        return client
+
+def get_usage(message: Any) -> Dict[str, int]:
+    """
+    从 LLM 返回的消息中提取 token 用量：
+    - prompt / completion 优先使用 langchain 的 usage_metadata
+    - 缓存命中读取 DeepSeek 的 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+      退回到 OpenAI 的 prompt_tokens_details.cached_tokens
+    """
+    raw = (getattr(message, "response_metadata", None) or {}).get("token_usage") or {}
+    usage = getattr(message, "usage_metadata", None) or {}
+
+    if usage:
+        prompt = int(usage.get("input_tokens", 0) or 0)
+        completion = int(usage.get("output_tokens", 0) or 0)
+    else:
+        prompt = int(raw.get("prompt_tokens", 0) or 0)
+        completion = int(raw.get("completion_tokens", 0) or 0)
+
+    if "prompt_cache_hit_tokens" in raw:
+        hit = int(raw.get("prompt_cache_hit_tokens") or 0)
+    else:
+        details = raw.get("prompt_tokens_details") or {}
+        hit = int(details.get("cached_tokens") or 0)
+        if not hit:
+            hit = int((usage.get("input_token_details") or {}).get("cache_read") or 0)
+    miss = int(raw.get("prompt_cache_miss_tokens", prompt - hit) or 0)
+
+    return {
+        "prompt_tokens": prompt,
+        "completion_tokens": completion,
+        "cache_hit_tokens": hit,
+        "cache_miss_tokens": max(miss, 0),
+    }
+
+
+@dataclass
+class UsageMeter:
+    """累计一次运行中所有 LLM 调用的 token 用量与缓存命中"""
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cache_hit_tokens: int = 0
+    cache_miss_tokens: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    def add(self, usage: Dict[str, int]) -> None:
+        with self._lock:
+            self.calls += 1
+            self.prompt_tokens += usage.get("prompt_tokens", 0)
+            self.completion_tokens += usage.get("completion_tokens", 0)
+            self.cache_hit_tokens += usage.get("cache_hit_tokens", 0)
+            self.cache_miss_tokens += usage.get("cache_miss_tokens", 0)
+
+    @property
+    def cache_hit_rate(self) -> float:
+        total = self.cache_hit_tokens + self.cache_miss_tokens
+        return self.cache_hit_tokens / total if total else 0.0
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cache_hit_tokens": self.cache_hit_tokens,
+            "cache_miss_tokens": self.cache_miss_tokens,
+            "cache_hit_rate": round(self.cache_hit_rate, 3),
+        }
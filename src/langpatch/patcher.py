@@ -1,15 +1,15 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
-
-from langchain_core.messages import SystemMessage, HumanMessage
+from typing import Callable, List, Optional, Sequence, Tuple
 
+from .budget import ShareExceeded, TokenBudget
 from .config import Settings
-from .llm import get_llm
-from .prompts import PATCH_SYSTEM, PATCH_USER
+from .llm import UsageMeter, estimate_tokens, get_llm, get_usage
+from .prompt_layout import PromptLayout, patch_layout, repair_layout
 from .fs_utils import read_text_safely
 from .diff_utils import (
+    Hunk,
     sanitize_diff,
     extract_and_fix_hunks,
     looks_like_unified_diff,
@@ -20,9 +20,30 @@ from .diff_utils import (
 class FilePatch:
     rel_path: str
     diff: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+
+
+class PatchGenerationError(RuntimeError):
+    """
+    模型已返回但没有可用的 diff：用量已经记账，附在异常上便于调用方统计
+    """
+
+    def __init__(self, message: str, prompt_tokens: int = 0, completion_tokens: int = 0):
+        super().__init__(message)
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
 
 
-def _make_diff_header(rel_path: str) -> str:
+def _make_diff_header(rel_path: str, is_new: bool = False) -> str:
+    """文件头由本地拼接：planner 给出的新文件（仓库中尚不存在）使用 /dev/null 作为旧侧"""
+    if is_new:
+        return (
+            f"diff --git a/{rel_path} b/{rel_path}\n"
+            f"new file mode 100644\n"
+            f"--- /dev/null\n"
+            f"+++ b/{rel_path}\n"
+        )
     return (
         f"diff --git a/{rel_path} b/{rel_path}\n"
         f"--- a/{rel_path}\n"
@@ -30,41 +51,252 @@ def _make_diff_header(rel_path: str) -> str:
     )
 
 
+def _read_original(settings: Settings, repo_root: Path, rel_path: str) -> str:
+    abs_path = (repo_root / rel_path).resolve()
+    if abs_path.exists():
+        return read_text_safely(
+            abs_path,
+            max_chars=settings.max_chars_per_file,
+            max_bytes=settings.max_file_bytes,
+        )
+    return ""
+
+
+def focus_content(text: str, ranges: Sequence[Tuple[int, int]], margin: int = 20) -> str:
+    """
+    只保留 ranges（1-based 闭区间）前后 margin 行，其余行折叠为省略标记。
+    保留下来的行与原文件逐字一致，生成的 hunk 依然可以按上下文匹配。
+    """
+    lines = text.splitlines()
+    keep = [False] * len(lines)
+    for start, end in ranges:
+        for i in range(max(1, start - margin), min(len(lines), end + margin) + 1):
+            keep[i - 1] = True
+
+    out: List[str] = []
+    i = 0
+    while i < len(lines):
+        if keep[i]:
+            out.append(lines[i])
+            i += 1
+            continue
+        j = i
+        while j < len(lines) and not keep[j]:
+            j += 1
+        out.append(f"# ...[省略第 {i + 1}-{j} 行]...")
+        i = j
+    return "\n".join(out) + "\n"
+
+
+def _budgeted_layout(
+    build: Callable[[str], PromptLayout],
+    original: str,
+    rel_path: str,
+    budget: Optional[TokenBudget],
+    focus: Optional[Sequence[Tuple[int, int]]],
+    share: float = 1.0,
+) -> PromptLayout:
+    """
+    按预算逐级降级文件内容：完整内容 -> 只保留相关区域 -> 按比例截断；
+    截断后仍超出（或固定部分已超出）该文件的份额时抛出 ShareExceeded
+    """
+    layout = build(original)
+    if budget is None:
+        return layout
+
+    allowance = budget.allowance(share)
+    if estimate_tokens(layout.full_text()) <= allowance:
+        return layout
+
+    content = original
+    if focus:
+        content = focus_content(original, focus)
+        layout = build(content)
+        budget.degrade(f"{rel_path}: 只发送相关区域（{len(focus)} 段）")
+        if estimate_tokens(layout.full_text()) <= allowance:
+            return layout
+
+    def truncated(n: int) -> PromptLayout:
+        return build(content[:n] + "\n\n# [TRUNCATED]\n")
+
+    room = allowance - estimate_tokens(truncated(0).full_text())
+    if room <= 0:
+        raise ShareExceeded(
+            f"{rel_path}: prompt 固定部分已超出该文件的预算份额（{allowance} tokens）"
+        )
+    keep = int(len(content) * room / max(1, estimate_tokens(content)))
+    layout = truncated(keep)
+    # 按比例估算可能因内容分布不均略微超出，逐步收缩直到满足份额
+    while keep > 0 and estimate_tokens(layout.full_text()) > allowance:
+        keep = int(keep * 0.9)
+        layout = truncated(keep)
+    budget.degrade(f"{rel_path}: 内容截断至 {keep} 字符")
+    return layout
+
+
+def _invoke_for_patch(
+    settings: Settings,
+    rel_path: str,
+    layout: PromptLayout,
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+    temperature: Optional[float] = None,
+    is_new: bool = False,
+    reservation: Optional[Tuple[int, int]] = None,
+) -> FilePatch:
+    """reservation：调用方已预占的预算（并行候选一次性预占）；为空时在这里预占"""
+    llm = get_llm(settings)
+
+    prompt_chars = len(layout.full_text())
+    if budget is not None and reservation is None:
+        reservation = budget.reserve(estimate_tokens(layout.full_text()), prompt_chars, rel_path)
+    reservation = reservation or (0, 0)
+
+    kwargs = {} if temperature is None else {"temperature": temperature}
+    try:
+        resp = llm.invoke(layout.to_messages(), **kwargs)
+    except BaseException:
+        if budget is not None:
+            budget.release(reservation)
+        raise
+    usage = get_usage(resp)
+    if meter is not None:
+        meter.add(usage)
+    if budget is not None:
+        budget.record(usage, prompt_chars, reservation)
+    raw = sanitize_diff(resp.content)
+
+    hunks = extract_and_fix_hunks(raw)
+    if not hunks:
+        raise PatchGenerationError(
+            f"{rel_path}: 未生成任何合法 diff hunk",
+            prompt_tokens=usage["prompt_tokens"],
+            completion_tokens=usage["completion_tokens"],
+        )
+
+    diff = _make_diff_header(rel_path, is_new) + hunks
+    return FilePatch(
+        rel_path=rel_path,
+        diff=diff,
+        prompt_tokens=usage["prompt_tokens"],
+        completion_tokens=usage["completion_tokens"],
+    )
+
+
+def build_patch_layout(
+    settings: Settings,
+    repo_root: Path,
+    requirement: str,
+    design_notes: List[str],
+    rel_path: str,
+    budget: Optional[TokenBudget] = None,
+    focus: Optional[Sequence[Tuple[int, int]]] = None,
+    share: float = 1.0,
+) -> PromptLayout:
+    """
+    按预算构建单文件 patch 的 prompt：
+    focus：检索命中的行区间，预算不足时只发送这些区域
+    share：每次调用占该文件预算的比例（n 个并行候选各取 1/n）
+    """
+    original = _read_original(settings, repo_root, rel_path)
+    return _budgeted_layout(
+        lambda content: patch_layout(
+            requirement=requirement,
+            design_notes=design_notes,
+            path=rel_path,
+            content=content,
+        ),
+        original, rel_path, budget, focus, share,
+    )
+
+
 def generate_file_patch(
     settings: Settings,
     repo_root: Path,
     requirement: str,
     design_notes: List[str],
     rel_path: str,
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+    focus: Optional[Sequence[Tuple[int, int]]] = None,
+    temperature: Optional[float] = None,
+    layout: Optional[PromptLayout] = None,
+    reservation: Optional[Tuple[int, int]] = None,
 ) -> FilePatch:
-    llm = get_llm(settings)
-    abs_path = (repo_root / rel_path).resolve()
+    """
+    temperature：覆盖默认温度（并行生成多个候选时使用）
+    layout / reservation：并行候选共用同一个 prompt 与一次性预占的预算；为空时在这里构建 / 预占
+    """
+    if layout is None:
+        layout = build_patch_layout(
+            settings, repo_root, requirement, design_notes, rel_path, budget, focus,
+        )
+    return _invoke_for_patch(
+        settings, rel_path, layout, meter, budget, temperature,
+        is_new=not (repo_root / rel_path).exists(),
+        reservation=reservation,
+    )
 
-    original = ""
-    if abs_path.exists():
-        original = read_text_safely(abs_path, max_chars=settings.max_chars_per_file)
-
-    msg = [
-        SystemMessage(content=PATCH_SYSTEM),
-        HumanMessage(
-            content=PATCH_USER.format(
-                requirement=requirement,
-                design_notes="\n".join(f"- {n}" for n in design_notes),
-                path=rel_path,
-                content=original,
-            )
-        ),
-    ]
 
-    raw = llm.invoke(msg).content
-    raw = sanitize_diff(raw)
+def excerpt_lines(text: str, center: int, radius: int = 15) -> str:
+    """
+    截取原文件 center 行附近的内容，带行号，便于模型对齐上下文
+    """
+    lines = text.splitlines()
+    if not lines:
+        return "(文件为空或不存在)"
+    start = max(1, center - radius)
+    end = min(len(lines), center + radius)
+    return "\n".join(f"{i:>5} | {lines[i - 1]}" for i in range(start, end + 1))
 
-    hunks = extract_and_fix_hunks(raw)
-    if not hunks:
-        raise RuntimeError(f"{rel_path}: 未生成任何合法 diff hunk")
 
-    diff = _make_diff_header(rel_path) + hunks
-    return FilePatch(rel_path=rel_path, diff=diff)
+def repair_file_patch(
+    settings: Settings,
+    repo_root: Path,
+    requirement: str,
+    design_notes: List[str],
+    rel_path: str,
+    bad_diff: str,
+    error: str,
+    hunk: Optional[Hunk] = None,
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+    focus: Optional[Sequence[Tuple[int, int]]] = None,
+) -> FilePatch:
+    """
+    只针对单个文件重新生成 diff：
+    - 附带 git 报错、上一次的 diff
+    - 附带出错 hunk 附近的原始行（无法定位时取文件开头）
+    """
+    original = _read_original(settings, repo_root, rel_path)
+
+    if hunk is not None:
+        center = hunk.old_start + max(hunk.old_len, 1) // 2
+        radius = max(15, hunk.old_len)
+    else:
+        center, radius = 1, 30
+
+    excerpt = excerpt_lines(original, center, radius)
+    # 预算不足时优先保留出错 hunk 所在区域
+    if hunk is not None:
+        focus = list(focus or []) + [(hunk.old_start, hunk.old_start + hunk.old_len)]
+
+    layout = _budgeted_layout(
+        lambda content: repair_layout(
+            requirement=requirement,
+            design_notes=design_notes,
+            path=rel_path,
+            content=content,
+            bad_diff=bad_diff.rstrip() or "(无)",
+            error=error.strip(),
+            excerpt=excerpt,
+        ),
+        original, rel_path, budget, focus,
+    )
+    return _invoke_for_patch(
+        settings, rel_path, layout, meter, budget,
+        is_new=not (repo_root / rel_path).exists(),
+    )
 
 
 def merge_diffs(patches: List[FilePatch]) -> str:
@@ -1,13 +1,16 @@
 from __future__ import annotations
 import json
 import re
-from typing import Any, Dict, List
-from langchain_core.messages import SystemMessage, HumanMessage
+from typing import Any, Dict, List, Optional
 
-from .prompts import PLANNER_SYSTEM, PLANNER_USER
-from .llm import get_llm
+from .prompt_layout import planner_layout
+from .budget import TokenBudget
+from .llm import UsageMeter, estimate_tokens, get_llm, get_usage
 from .config import Settings
 
+# planner 最多占用剩余预算的比例，其余留给逐文件的 patch 调用
+PLANNER_BUDGET_SHARE = 0.25
+
 def _format_snippets(chunks: List[dict], max_chars: int = 60_000) -> str:
     parts: List[str] = []
     total = 0
@@ -22,18 +25,44 @@ def _format_snippets(chunks: List[dict], max_chars: int = 60_000) -> str:
         total += len(block)
     return "\n---\n".join(parts)
 
-def plan_changes(settings: Settings, requirement: str, retrieved_chunks: List[dict]) -> Dict[str, Any]:
+def plan_changes(
+    settings: Settings,
+    requirement: str,
+    retrieved_chunks: List[dict],
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+) -> Dict[str, Any]:
     llm = get_llm(settings)
 
-    snippets = _format_snippets(retrieved_chunks)
+    max_chars = 60_000
+    snippets = _format_snippets(retrieved_chunks, max_chars=max_chars)
+    layout = planner_layout(requirement=requirement, snippets=snippets)
+
+    reservation = (0, 0)
+    if budget is not None:
+        # 预算不足时逐步减少代码片段（至少保留 4k 字符）
+        allowance = budget.allowance(share=PLANNER_BUDGET_SHARE)
+        while estimate_tokens(layout.full_text()) > allowance and max_chars > 4_000:
+            max_chars //= 2
+            snippets = _format_snippets(retrieved_chunks, max_chars=max_chars)
+            layout = planner_layout(requirement=requirement, snippets=snippets)
+        if max_chars < 60_000:
+            budget.degrade(f"planner: 代码片段缩减至 {max_chars} 字符")
+        reservation = budget.reserve(estimate_tokens(layout.full_text()), len(layout.full_text()), "planner")
 
-    msg = [
-        SystemMessage(content=PLANNER_SYSTEM),
-        HumanMessage(content=PLANNER_USER.format(requirement=requirement, snippets=snippets)),
-    ]
-    resp = llm.invoke(msg).content
+    try:
+        resp = llm.invoke(layout.to_messages())
+    except BaseException:
+        if budget is not None:
+            budget.release(reservation)
+        raise
+    usage = get_usage(resp)
+    if meter is not None:
+        meter.add(usage)
+    if budget is not None:
+        budget.record(usage, len(layout.full_text()), reservation)
 
-    return _parse_planner_json(resp)
+    return _parse_planner_json(resp.content)
 
 
 def _parse_planner_json(raw: str) -> Dict[str, Any]:
@@ -0,0 +1,113 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import List
+
+from langchain_core.messages import BaseMessage, HumanMessage, SystemMessage
+
+from .prompts import (
+    PATCH_FILE,
+    PATCH_REQUIREMENT,
+    PATCH_SYSTEM,
+    PATCH_TASK,
+    PLANNER_FORMAT,
+    PLANNER_REQUIREMENT,
+    PLANNER_SNIPPETS,
+    PLANNER_SYSTEM,
+    REPAIR_TASK,
+)
+
+
+@dataclass
+class PromptLayout:
+    """
+    按「稳定 -> 易变」顺序组织的 prompt：
+    - system 固定在最前
+    - blocks 依次拼接为一条 user 消息，越靠前的块在多次调用间越稳定
+
+    DeepSeek 按前缀缓存计费，前缀一致的部分会以缓存价格计费并更快返回。
+    """
+    system: str
+    blocks: List[str] = field(default_factory=list)
+
+    def render(self) -> str:
+        return "".join(self.blocks)
+
+    def to_messages(self) -> List[BaseMessage]:
+        return [
+            SystemMessage(content=self.system),
+            HumanMessage(content=self.render()),
+        ]
+
+    def full_text(self) -> str:
+        return self.system + "\n" + self.render()
+
+
+def common_prefix_chars(a: PromptLayout, b: PromptLayout) -> int:
+    """
+    两个 layout 共享的前缀字符数（用于检查 / 调试缓存友好程度）
+    """
+    x, y = a.full_text(), b.full_text()
+    n = min(len(x), len(y))
+    i = 0
+    while i < n and x[i] == y[i]:
+        i += 1
+    return i
+
+
+def _format_notes(design_notes: List[str]) -> str:
+    return "\n".join(f"- {n}" for n in design_notes)
+
+
+def planner_layout(requirement: str, snippets: str) -> PromptLayout:
+    return PromptLayout(
+        system=PLANNER_SYSTEM,
+        blocks=[
+            PLANNER_FORMAT,
+            PLANNER_SNIPPETS.format(snippets=snippets),
+            PLANNER_REQUIREMENT.format(requirement=requirement),
+        ],
+    )
+
+
+def patch_layout(
+    requirement: str,
+    design_notes: List[str],
+    path: str,
+    content: str,
+) -> PromptLayout:
+    """
+    单文件 patch 的 prompt：
+    需求块在同一 plan 的所有文件间共享，文件块在同一文件的重试间共享
+    """
+    return PromptLayout(
+        system=PATCH_SYSTEM,
+        blocks=[
+            PATCH_REQUIREMENT.format(
+                requirement=requirement,
+                design_notes=_format_notes(design_notes),
+            ),
+            PATCH_FILE.format(path=path, content=content),
+            PATCH_TASK,
+        ],
+    )
+
+
+def repair_layout(
+    requirement: str,
+    design_notes: List[str],
+    path: str,
+    content: str,
+    bad_diff: str,
+    error: str,
+    excerpt: str,
+) -> PromptLayout:
+    """
+    修复 prompt 与 patch_layout 共享「system + 需求 + 文件」前缀，只替换末尾的任务块
+    """
+    layout = patch_layout(requirement, design_notes, path, content)
+    layout.blocks[-1] = REPAIR_TASK.format(
+        bad_diff=bad_diff,
+        error=error,
+        excerpt=excerpt,
+    )
+    return layout
@@ -16,25 +16,22 @@ PLANNER_SYSTEM = """你是一名资深 Python 工程师，长期维护带有【
 - 输出必须是【严格合法的 JSON】
 """
 
-PLANNER_USER = """【用户需求】
-{requirement}
-
-【与需求最相关的代码片段】
-{snippets}
+# 以下各段按「稳定 -> 易变」顺序拼接（见 prompt_layout.py），
+# 让多次调用共享尽可能长的前缀，命中 DeepSeek 的前缀缓存。
 
-请只输出 JSON，结构如下：
-{{
+PLANNER_FORMAT = """请只输出 JSON，结构如下：
+{
   "files_to_modify": [
-    {{
+    {
       "path": "相对路径（例如 app/api/user.py）",
       "reason": "为什么需要修改这个文件"
-    }}
+    }
   ],
   "new_files": [
-    {{
+    {
       "path": "相对路径（例如 app/api/new_module.py）",
       "reason": "为什么需要新增这个文件"
-    }}
+    }
   ],
   "design_notes": [
     "实现层面的关键设计约束（例如保持向后兼容）"
@@ -42,7 +39,19 @@ PLANNER_USER = """【用户需求】
   "test_notes": [
     "需要关注或补充的测试点"
   ]
-}}
+}
+
+"""
+
+PLANNER_SNIPPETS = """【与需求最相关的代码片段】
+{snippets}
+
+"""
+
+PLANNER_REQUIREMENT = """【用户需求】
+{requirement}
+
+请只输出 JSON：
 """
 
 # =========================
@@ -71,13 +80,18 @@ PATCH_SYSTEM = """你是一名非常谨慎的 Python 代码编辑者，擅长维
 - 生成的 diff 必须可以被 `git apply` 成功应用
 """
 
-PATCH_USER = """【用户需求】
+# 同一个 plan 的各文件调用共享「需求 + 设计说明」；
+# 同一文件的重试 / 修复再共享「文件内容」。
+
+PATCH_REQUIREMENT = """【用户需求】
 {requirement}
 
 【设计说明】
 {design_notes}
 
-【目标文件】
+"""
+
+PATCH_FILE = """【目标文件】
 {path}
 
 【原始文件内容】
@@ -85,5 +99,27 @@ PATCH_USER = """【用户需求】
 {content}
 FILE
 
-请只输出这个文件的 unified diff：
+"""
+
+PATCH_TASK = """请只输出这个文件的 unified diff：
+"""
+
+# =========================
+# Patch Repair Prompts
+# =========================
+
+REPAIR_TASK = """【上一次生成的 diff】
+<<<DIFF
+{bad_diff}
+DIFF
+
+【git apply --check 报错】
+{error}
+
+【出错位置附近的原始行（行号 | 内容）】
+{excerpt}
+
+上一次的 diff 无法被 `git apply` 应用。
+请对照上面的原始行，修正上下文行与行号，使 diff 与原文件逐字一致。
+请只输出修正后的这个文件的完整 unified diff：
 """
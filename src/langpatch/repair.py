@@ -0,0 +1,315 @@
+from __future__ import annotations
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .budget import BudgetExhausted, ShareExceeded, TokenBudget
+from .config import Settings
+from .diff_utils import (
+    is_header_error,
+    locate_failed_hunk,
+    looks_like_unified_diff,
+    parse_apply_error,
+    sanitize_diff,
+)
+from .git_utils import apply_check_text
+from .llm import UsageMeter, estimate_tokens
+from .patcher import (
+    FilePatch,
+    PatchGenerationError,
+    build_patch_layout,
+    generate_file_patch,
+    repair_file_patch,
+)
+
+
+@dataclass
+class RepairStats:
+    """
+    修复循环的统计信息：
+    - attempts：修复请求次数（不含首次生成）
+    - repair_*_tokens：修复请求消耗的 token
+    - time_to_valid_s：每个文件从开始生成到拿到可应用 patch 的耗时，
+      按首轮方式分开记录：{"single" | "candidates": {文件: 秒}}
+    - late_candidates / late_candidate_tokens：已选出胜者后仍在途、无法取消的候选；
+      它们照常返回并计入 UsageMeter 与预算，这里单独统计其消耗
+    """
+    files_total: int = 0
+    files_ok_first_try: int = 0
+    files_repaired: int = 0
+    files_failed: int = 0
+    attempts: int = 0
+    repair_prompt_tokens: int = 0
+    repair_completion_tokens: int = 0
+    candidates: int = 0
+    late_candidates: int = 0
+    late_candidate_tokens: int = 0
+    failures: Dict[str, str] = field(default_factory=dict)
+    time_to_valid_s: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+    @property
+    def success_rate(self) -> float:
+        if not self.files_total:
+            return 0.0
+        return (self.files_ok_first_try + self.files_repaired) / self.files_total
+
+    def as_dict(self) -> Dict[str, object]:
+        return {
+            "files_total": self.files_total,
+            "files_ok_first_try": self.files_ok_first_try,
+            "files_repaired": self.files_repaired,
+            "files_failed": self.files_failed,
+            "attempts": self.attempts,
+            "repair_prompt_tokens": self.repair_prompt_tokens,
+            "repair_completion_tokens": self.repair_completion_tokens,
+            "success_rate": round(self.success_rate, 3),
+            "candidates": self.candidates,
+            "late_candidates": self.late_candidates,
+            "late_candidate_tokens": self.late_candidate_tokens,
+            "time_to_valid_s": {
+                path: {
+                    "files": len(times),
+                    "mean": round(sum(times.values()) / len(times), 2),
+                }
+                for path, times in self.time_to_valid_s.items()
+                if times
+            },
+        }
+
+    def add_time_to_valid(self, path: str, rel_path: str, seconds: float) -> None:
+        self.time_to_valid_s.setdefault(path, {})[rel_path] = seconds
+
+    def charge_late(self, fut: "Future[FilePatch]") -> None:
+        """在途候选结束时回调：统计胜者选出后仍产生的 token 消耗"""
+        if fut.cancelled():
+            return
+        e = fut.exception()
+        if e is None:
+            fp = fut.result()
+            tokens = fp.prompt_tokens + fp.completion_tokens
+        elif isinstance(e, PatchGenerationError):
+            tokens = e.prompt_tokens + e.completion_tokens
+        else:
+            return
+        with self._lock:
+            self.late_candidate_tokens += tokens
+
+
+def validate_file_patch(repo_root: Path, fp: FilePatch) -> Tuple[bool, str]:
+    """
+    单文件校验：先做格式检查，再做 `git apply --check`
+    """
+    if not looks_like_unified_diff(fp.diff):
+        return False, f"{fp.rel_path} 输出不是合法 unified diff"
+    return apply_check_text(repo_root, fp.diff)
+
+
+def locate_merged_failure(patches: List[FilePatch], message: str) -> Optional[int]:
+    """
+    合并后的 patch 未通过 `git apply --check` 时，找出出错的单文件 patch（下标）：
+    优先按报错中的文件路径匹配，其次按 patch 行号落在哪个文件的 diff 内（与 merge_diffs 的拼接方式一致）
+    """
+    path, _, patch_line = parse_apply_error(message)
+    if path is not None:
+        for i, p in enumerate(patches):
+            if p.rel_path == path:
+                return i
+    if patch_line is not None and patches:
+        # merge_diffs 在文件之间插入一个空行；git 报告的行号可能是出错 diff 结束后的下一行
+        end = 0
+        for i, p in enumerate(patches):
+            end += len(p.diff.rstrip().splitlines()) + 1
+            if patch_line <= end:
+                return i
+        return len(patches) - 1
+    return None
+
+
+def candidate_temperatures(n: int) -> List[float]:
+    """第一个候选保持 temperature=0（与单次生成一致），其余逐步升温以增加多样性"""
+    return [round(min(1.0, 0.3 * i), 2) for i in range(n)]
+
+
+def generate_first_valid(
+    settings: Settings,
+    repo_root: Path,
+    requirement: str,
+    design_notes: List[str],
+    rel_path: str,
+    n: int,
+    stats: RepairStats,
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+    focus: Optional[Sequence[Tuple[int, int]]] = None,
+) -> Tuple[bool, Optional[FilePatch], str]:
+    """
+    并行请求 n 个候选 patch，每个返回后立即校验，
+    第一个通过 `git apply --check` 的胜出，其余未开始的直接取消、已在途的不再等待
+    （在途请求无法中断，仍会计入用量与预算，由 stats.late_candidates 单独统计）。
+    prompt 按该文件预算的 1/n 只构建一次，n 个候选共用；预算在提交前一次性为 n 次调用预占，
+    不足时 BudgetExhausted 直接抛出（与单次生成一致），n 个候选不会超出全局上限。
+    返回 (是否有效, patch, 错误)；全部失败时返回最后一个候选与错误，交给修复循环继续处理。
+    """
+    layout = build_patch_layout(
+        settings, repo_root, requirement, design_notes, rel_path, budget, focus, share=1.0 / n,
+    )
+    per_call: Optional[Tuple[int, int]] = None
+    if budget is not None:
+        text = layout.full_text()
+        per_call = budget.reserve(estimate_tokens(text), len(text), rel_path, calls=n)
+
+    pool = ThreadPoolExecutor(max_workers=n)
+    futures = {
+        pool.submit(
+            generate_file_patch,
+            settings=settings,
+            repo_root=repo_root,
+            rel_path=rel_path,
+            requirement=requirement,
+            design_notes=design_notes,
+            meter=meter,
+            budget=budget,
+            temperature=t,
+            layout=layout,
+            reservation=per_call,
+        )
+        for t in candidate_temperatures(n)
+    }
+    stats.candidates += n
+
+    last: Optional[FilePatch] = None
+    err = f"{rel_path}: 没有候选 patch"
+    seen: set = set()
+    try:
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                seen.add(fut)
+                try:
+                    fp = fut.result()
+                except (RuntimeError, BudgetExhausted) as e:
+                    # 单个候选失败（含预算问题）不影响其他候选，也不中止整次运行
+                    err = str(e)
+                    continue
+                fp.diff = sanitize_diff(fp.diff)
+                ok, msg = validate_file_patch(repo_root, fp)
+                if ok:
+                    return True, fp, msg
+                last, err = fp, msg
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+        for fut in futures - seen:
+            if fut.cancelled():
+                # 未开始的候选不会记账，归还它的预占
+                if budget is not None and per_call is not None:
+                    budget.release(per_call)
+            else:
+                stats.late_candidates += 1
+                fut.add_done_callback(stats.charge_late)
+
+    return False, last, err
+
+
+def generate_with_repair(
+    settings: Settings,
+    repo_root: Path,
+    requirement: str,
+    design_notes: List[str],
+    rel_path: str,
+    stats: RepairStats,
+    meter: Optional[UsageMeter] = None,
+    budget: Optional[TokenBudget] = None,
+    focus: Optional[Sequence[Tuple[int, int]]] = None,
+) -> Optional[FilePatch]:
+    """
+    生成单个文件的 patch，失败时只针对该文件做有限次修复：
+    - 每次修复都带上 git 报错与出错 hunk 附近的原始行
+    - 文件头层面的错误（文件不存在 / 已存在）不是模型输出的问题，不再请求修复
+    - 超过 settings.max_repair_attempts 仍失败则返回 None（不影响其他文件）
+    - 预算耗尽时 BudgetExhausted 直接向上抛出，由调用方中止；
+      修复 prompt 超出该文件份额（ShareExceeded）时只放弃这个文件
+    - settings.patch_candidates > 1 时首轮并行生成多个候选，取第一个可应用的
+    """
+    stats.files_total += 1
+    t0 = time.perf_counter()
+
+    fp: Optional[FilePatch] = None
+    bad_diff = ""
+    path = "candidates" if settings.patch_candidates > 1 else "single"
+    if settings.patch_candidates > 1:
+        ok, fp, err = generate_first_valid(
+            settings, repo_root, requirement, design_notes, rel_path,
+            settings.patch_candidates, stats, meter, budget, focus,
+        )
+    else:
+        try:
+            fp = generate_file_patch(
+                settings=settings,
+                repo_root=repo_root,
+                rel_path=rel_path,
+                requirement=requirement,
+                design_notes=design_notes,
+                meter=meter,
+                budget=budget,
+                focus=focus,
+            )
+            fp.diff = sanitize_diff(fp.diff)
+            ok, err = validate_file_patch(repo_root, fp)
+        except RuntimeError as e:
+            ok, err = False, str(e)
+
+    if ok:
+        stats.files_ok_first_try += 1
+        stats.add_time_to_valid(path, rel_path, time.perf_counter() - t0)
+        return fp
+
+    for _ in range(settings.max_repair_attempts):
+        if is_header_error(err):
+            break
+        if fp is not None:
+            bad_diff = fp.diff
+        stats.attempts += 1
+        try:
+            fp = repair_file_patch(
+                settings=settings,
+                repo_root=repo_root,
+                requirement=requirement,
+                design_notes=design_notes,
+                rel_path=rel_path,
+                bad_diff=bad_diff,
+                error=err,
+                hunk=locate_failed_hunk(bad_diff, err),
+                meter=meter,
+                budget=budget,
+                focus=focus,
+            )
+        except ShareExceeded as e:
+            # 修复 prompt 放不进该文件的份额：放弃这个文件，不挤占后续文件
+            err = str(e)
+            break
+        except PatchGenerationError as e:
+            stats.repair_prompt_tokens += e.prompt_tokens
+            stats.repair_completion_tokens += e.completion_tokens
+            err = str(e)
+            continue
+        except RuntimeError as e:
+            err = str(e)
+            continue
+
+        stats.repair_prompt_tokens += fp.prompt_tokens
+        stats.repair_completion_tokens += fp.completion_tokens
+        fp.diff = sanitize_diff(fp.diff)
+        ok, err = validate_file_patch(repo_root, fp)
+        if ok:
+            stats.files_repaired += 1
+            stats.add_time_to_valid(path, rel_path, time.perf_counter() - t0)
+            return fp
+
+    stats.files_failed += 1
+    stats.failures[rel_path] = err
+    return None
@@ -1,30 +1,198 @@
 from __future__ import annotations
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Sequence
 
 import chromadb
 from sentence_transformers import SentenceTransformer
 
-from .indexer import get_chroma_client, get_collection
+from .indexer import FILES_COLLECTION_NAME, dir_key, get_chroma_client, list_shards
+
+
+@dataclass
+class RetrievalStats:
+    """
+    - shards：每个分片的大小、查询耗时与命中数：{分片: {"size", "latency_ms", "hits"}}
+    - two_stage：两阶段检索的文件数、各阶段耗时，以及与平铺检索对比的召回率 / 耗时
+    """
+    shards: Dict[str, Dict[str, float]] = field(default_factory=dict)
+    two_stage: Dict[str, Any] = field(default_factory=dict)
+
+
+def scope_where(scope: Sequence[str]) -> Optional[Dict[str, Any]]:
+    """
+    检索范围转为 Chroma where：路径前缀 s（共 d 级）命中 dir<d> == s 的目录，
+    或 rel_path == s 的单个文件。在查询内过滤，范围外的结果不会占用 top_k 名额
+    """
+    if not scope:
+        return None
+    conds: List[Dict[str, Any]] = []
+    for s in scope:
+        conds.append({dir_key(len(s.split("/"))): s})
+        conds.append({"rel_path": s})
+    return {"$or": conds}
+
+
+def _and_where(*wheres: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    parts = [w for w in wheres if w]
+    if not parts:
+        return None
+    return parts[0] if len(parts) == 1 else {"$and": parts}
+
+
+def _shard_overlaps(shard: str, scope: Sequence[str]) -> bool:
+    """
+    分片与检索范围是否相交：
+    - 默认分片（""）可能包含任何路径，始终参与
+    - 分片前缀在某个 scope 之下，或某个 scope 在分片前缀之下
+    """
+    if not shard:
+        return True
+    return any(
+        shard == s or shard.startswith(s + "/") or s.startswith(shard + "/")
+        for s in scope
+    )
+
+
+def _query_shard(
+    col: chromadb.Collection,
+    q_emb: List[float],
+    n_results: int,
+    where: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    size = col.count()
+    res: Dict[str, Any] = {"documents": [[]], "metadatas": [[]], "distances": [[]]}
+    if size:
+        res = col.query(
+            query_embeddings=[q_emb],
+            n_results=min(n_results, size),
+            where=where,
+            include=["documents", "metadatas", "distances"],
+        )
+    res["_size"] = size
+    res["_latency_ms"] = (time.perf_counter() - t0) * 1000
+    return res
+
+
+def _fan_out(
+    shards: Dict[str, chromadb.Collection],
+    q_emb: List[float],
+    top_k: int,
+    scope: Sequence[str],
+    where: Optional[Dict[str, Any]] = None,
+    stats: Optional[RetrievalStats] = None,
+) -> List[Dict[str, Any]]:
+    """并发查询各分片（检索范围作为 where 条件下推），按距离合并取 top_k"""
+    where = _and_where(scope_where(scope), where)
+
+    names = list(shards.keys())
+    with ThreadPoolExecutor(max_workers=min(8, len(names))) as pool:
+        results = list(pool.map(lambda k: _query_shard(shards[k], q_emb, top_k, where), names))
+
+    out: List[Dict[str, Any]] = []
+    for name, res in zip(names, results):
+        hits = 0
+        for doc, meta, dist in zip(res["documents"][0], res["metadatas"][0], res["distances"][0]):
+            out.append({
+                "document": doc,
+                "meta": meta,
+                "distance": dist,
+            })
+            hits += 1
+        if stats is not None:
+            stats.shards[name or "(default)"] = {
+                "size": res["_size"],
+                "latency_ms": round(res["_latency_ms"], 1),
+                "hits": hits,
+            }
+
+    out.sort(key=lambda x: x["distance"])
+    return out[:top_k]
+
+
+def _top_files(
+    client: chromadb.Client,
+    q_emb: List[float],
+    n_files: int,
+    scope: Sequence[str],
+) -> List[str]:
+    """第一阶段：在文件级概要索引中选出最相关的文件；索引不存在时返回空"""
+    try:
+        col = client.get_collection(FILES_COLLECTION_NAME)
+    except Exception:
+        return []
+    size = col.count()
+    if not size:
+        return []
+    res = col.query(
+        query_embeddings=[q_emb],
+        n_results=min(n_files, size),
+        where=scope_where(scope),
+        include=["metadatas"],
+    )
+    return [m["rel_path"] for m in res["metadatas"][0]]
+
 
 def retrieve_top_chunks(
     index_dir: Path,
     embed_model: str,
     query: str,
     top_k: int,
+    scope: Optional[Sequence[str]] = None,
+    stats: Optional[RetrievalStats] = None,
+    coarse_files: int = 0,
+    compare_flat: bool = False,
 ) -> List[Dict[str, Any]]:
+    """
+    检索与 query 最相关的 top_k 个 chunk：
+    - 未指定 scope：并发查询所有分片，按距离合并
+    - 指定 scope（相对路径前缀）：只查询相交的分片，范围作为 where 条件在查询内过滤
+    - coarse_files > 0：两阶段检索，先在文件级索引中选出 coarse_files 个文件，
+      再只在这些文件的 chunk 中检索（where rel_path $in）；文件级索引缺失时退回平铺检索
+    - compare_flat：同时跑一次平铺检索，统计两阶段结果的召回率与耗时对比
+    """
     client = get_chroma_client(index_dir)
-    col = get_collection(client)
-    model = SentenceTransformer(embed_model, device="cpu")
+    shards = list_shards(client)
 
+    scope = [s.strip().strip("/") for s in (scope or []) if s.strip().strip("/")]
+    if scope:
+        shards = {k: v for k, v in shards.items() if _shard_overlaps(k, scope)}
+    if not shards:
+        return []
+
+    model = SentenceTransformer(embed_model, device="cpu")
     q_emb = model.encode([query], normalize_embeddings=True).tolist()[0]
-    res = col.query(query_embeddings=[q_emb], n_results=top_k, include=["documents", "metadatas", "distances"])
 
-    out: List[Dict[str, Any]] = []
-    for doc, meta, dist in zip(res["documents"][0], res["metadatas"][0], res["distances"][0]):
-        out.append({
-            "document": doc,
-            "meta": meta,
-            "distance": dist,
-        })
+    if coarse_files <= 0:
+        return _fan_out(shards, q_emb, top_k, scope, stats=stats)
+
+    t0 = time.perf_counter()
+    files = _top_files(client, q_emb, coarse_files, scope)
+    t1 = time.perf_counter()
+    if not files:
+        return _fan_out(shards, q_emb, top_k, scope, stats=stats)
+
+    out = _fan_out(shards, q_emb, top_k, scope, where={"rel_path": {"$in": files}}, stats=stats)
+    t2 = time.perf_counter()
+
+    if stats is not None:
+        stats.two_stage = {
+            "files": len(files),
+            "file_stage_ms": round((t1 - t0) * 1000, 1),
+            "chunk_stage_ms": round((t2 - t1) * 1000, 1),
+        }
+        if compare_flat:
+            t3 = time.perf_counter()
+            flat = _fan_out(shards, q_emb, top_k, scope)
+            flat_ms = (time.perf_counter() - t3) * 1000
+            flat_ids = {(c["meta"].get("rel_path"), c["meta"].get("symbol"), c["meta"].get("start_line")) for c in flat}
+            got_ids = {(c["meta"].get("rel_path"), c["meta"].get("symbol"), c["meta"].get("start_line")) for c in out}
+            stats.two_stage["flat_ms"] = round(flat_ms, 1)
+            stats.two_stage["recall_vs_flat"] = (
+                round(len(flat_ids & got_ids) / len(flat_ids), 3) if flat_ids else None
+            )
+
     return out
@@ -0,0 +1,178 @@
+from __future__ import annotations
+import io
+import json
+import time
+import zipfile
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from .chunker_py import CHUNKER_VERSION
+from .indexer import (
+    FILES_COLLECTION_NAME,
+    HASH_FILE,
+    INDEX_FORMAT,
+    drop_all_shards,
+    get_chroma_client,
+    get_collection,
+    get_files_collection,
+    list_shards,
+    load_hashes,
+    load_shard_spec,
+    save_hashes,
+)
+
+MANIFEST = "manifest.json"
+SNAPSHOT_VERSION = 1
+_PAGE = 1_000
+
+
+def _read_all(col: Any) -> Dict[str, Any]:
+    """分页读出 collection 的全部 ids / documents / metadatas / embeddings"""
+    ids: List[str] = []
+    docs: List[str] = []
+    metas: List[dict] = []
+    embs: List[Any] = []
+    offset = 0
+    while True:
+        res = col.get(
+            include=["documents", "metadatas", "embeddings"],
+            limit=_PAGE,
+            offset=offset,
+        )
+        if not res["ids"]:
+            break
+        ids += res["ids"]
+        docs += res["documents"]
+        metas += res["metadatas"]
+        embs += list(res["embeddings"])
+        offset += len(res["ids"])
+    return {"ids": ids, "documents": docs, "metadatas": metas, "embeddings": embs}
+
+
+def export_index(
+    index_dir: Path,
+    out_path: Path,
+    embed_model: str,
+    commit: str = "",
+) -> Dict[str, Any]:
+    """
+    将索引导出为单个 zip 快照：
+    - manifest.json：commit / embed model / chunker 版本 / 各分片信息
+    - shards/<collection>.npy：float16 embedding 矩阵
+    - shards/<collection>.jsonl：逐行 {id, document, metadata}，与矩阵行一一对应
+      （文件级概要索引 code_files 若存在，也按同样格式导出）
+    - file_hashes.json：文件级 hash 表（repo 相对路径）与分片配置
+    返回 manifest
+    """
+    client = get_chroma_client(index_dir)
+    shards_info: List[Dict[str, Any]] = []
+
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    cols = [(shard, col) for shard, col in list_shards(client).items()]
+    if any(getattr(c, "name", c) == FILES_COLLECTION_NAME for c in client.list_collections()):
+        cols.append((None, client.get_collection(FILES_COLLECTION_NAME)))
+
+    with zipfile.ZipFile(out_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for shard, col in cols:
+            data = _read_all(col)
+            n = len(data["ids"])
+            mat = np.asarray(data["embeddings"], dtype=np.float16)
+
+            buf = io.BytesIO()
+            np.save(buf, mat, allow_pickle=False)
+            zf.writestr(f"shards/{col.name}.npy", buf.getvalue())
+
+            lines = [
+                json.dumps({"id": i, "document": d, "metadata": m}, ensure_ascii=False)
+                for i, d, m in zip(data["ids"], data["documents"], data["metadatas"])
+            ]
+            zf.writestr(f"shards/{col.name}.jsonl", "\n".join(lines) + ("\n" if lines else ""))
+
+            shards_info.append({
+                "shard": shard,
+                "collection": col.name,
+                "count": n,
+                "dim": int(mat.shape[1]) if n else 0,
+            })
+
+        zf.writestr(HASH_FILE, json.dumps(
+            {
+                "format": INDEX_FORMAT,
+                "shards": list(load_shard_spec(index_dir)),
+                "files": load_hashes(index_dir),
+            },
+            ensure_ascii=False,
+        ))
+
+        manifest = {
+            "snapshot_version": SNAPSHOT_VERSION,
+            "index_format": INDEX_FORMAT,
+            "chunker_version": CHUNKER_VERSION,
+            "embed_model": embed_model,
+            "commit": commit,
+            "created_at": int(time.time()),
+            "shards": shards_info,
+        }
+        zf.writestr(MANIFEST, json.dumps(manifest, indent=2, ensure_ascii=False))
+
+    return manifest
+
+
+def import_index(
+    snapshot_path: Path,
+    index_dir: Path,
+    embed_model: str,
+    batch_size: int = 5_000,
+) -> Dict[str, Any]:
+    """
+    从快照恢复索引（覆盖 index_dir 中已有的分片）。
+    embed model / chunker 版本 / 索引格式不一致时拒绝导入，避免混入不兼容的向量。
+    导入后照常调用 build_or_update_index，只有与快照不同的文件会重新 embedding。
+    """
+    with zipfile.ZipFile(snapshot_path) as zf:
+        manifest = json.loads(zf.read(MANIFEST).decode("utf-8"))
+
+        mismatch: Optional[str] = None
+        if manifest.get("embed_model") != embed_model:
+            mismatch = f"embed model 不一致: {manifest.get('embed_model')} != {embed_model}"
+        elif manifest.get("chunker_version") != CHUNKER_VERSION:
+            mismatch = f"chunker 版本不一致: {manifest.get('chunker_version')} != {CHUNKER_VERSION}"
+        elif manifest.get("index_format") != INDEX_FORMAT:
+            mismatch = f"索引格式不一致: {manifest.get('index_format')} != {INDEX_FORMAT}"
+        if mismatch:
+            raise RuntimeError(f"无法导入索引快照 {snapshot_path}: {mismatch}")
+
+        client = get_chroma_client(index_dir)
+        drop_all_shards(client)
+
+        for info in manifest["shards"]:
+            if info["shard"] is None:
+                col = get_files_collection(client)
+            else:
+                col = get_collection(client, info["shard"])
+            if not info["count"]:
+                continue
+            mat = np.load(io.BytesIO(zf.read(f"shards/{info['collection']}.npy")), allow_pickle=False)
+            rows = [
+                json.loads(line)
+                for line in zf.read(f"shards/{info['collection']}.jsonl").decode("utf-8").splitlines()
+                if line.strip()
+            ]
+            if len(rows) != mat.shape[0]:
+                raise RuntimeError(f"快照分片 {info['collection']} 行数与向量数不一致")
+
+            for i in range(0, len(rows), batch_size):
+                part = rows[i:i + batch_size]
+                col.add(
+                    ids=[r["id"] for r in part],
+                    documents=[r["document"] for r in part],
+                    metadatas=[r["metadata"] for r in part],
+                    embeddings=mat[i:i + batch_size].astype(np.float32).tolist(),
+                )
+
+        hashes = json.loads(zf.read(HASH_FILE).decode("utf-8"))
+        save_hashes(index_dir, dict(hashes.get("files") or {}), hashes.get("shards") or ())
+
+    return manifest
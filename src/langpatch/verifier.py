@@ -0,0 +1,302 @@
+from __future__ import annotations
+import ast
+import hashlib
+import importlib.util
+import json
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from .git_utils import add_worktree, apply_patch, dirty_files, list_tracked_files, remove_worktree
+
+CACHE_DIR_NAME = "verify_cache"
+# pytest 退出码：5 表示没有收集到测试（如只选中了 conftest.py），视为通过；
+# 2/3/4 为中断、内部错误、用法错误，属于环境问题而非 patch 问题
+PYTEST_NO_TESTS = 5
+PYTEST_INFRA_CODES = (2, 3, 4)
+
+
+@dataclass
+class VerifyReport:
+    """
+    patch 验证结果：
+    - steps：各步骤耗时（秒）
+    - tests：按 import 图选出的测试文件
+    - infra_error：超时 / pytest 缺失或内部错误等环境问题；此类结果不写入缓存
+    """
+    ok: bool = False
+    cached: bool = False
+    touched: List[str] = field(default_factory=list)
+    compile_errors: Dict[str, str] = field(default_factory=dict)
+    tests: List[str] = field(default_factory=list)
+    tests_ok: Optional[bool] = None
+    output: str = ""
+    error: str = ""
+    infra_error: str = ""
+    steps: Dict[str, float] = field(default_factory=dict)
+
+    def as_dict(self) -> Dict[str, object]:
+        d = asdict(self)
+        d["steps"] = {k: round(v, 3) for k, v in self.steps.items()}
+        return d
+
+
+def touched_files(patch: str) -> List[str]:
+    """从 diff 头中提取被修改 / 新增的文件（b/ 侧路径）"""
+    out: List[str] = []
+    for m in re.finditer(r"^diff --git a/\S+ b/(\S+)$", patch, flags=re.MULTILINE):
+        if m.group(1) not in out:
+            out.append(m.group(1))
+    return out
+
+
+def _compile_one(path: str) -> Tuple[str, str]:
+    """在子进程中编译单个文件，返回 (路径, 错误信息；成功为空串)"""
+    try:
+        source = Path(path).read_bytes()
+        compile(source, path, "exec", dont_inherit=True)
+        return path, ""
+    except (SyntaxError, ValueError) as e:
+        return path, f"{type(e).__name__}: {e}"
+
+
+def compile_files(root: Path, rel_paths: List[str], workers: int = 4) -> Dict[str, str]:
+    """并行 byte-compile，返回 {相对路径: 错误}（只包含失败的文件）"""
+    py = [p for p in rel_paths if p.endswith(".py") and (root / p).exists()]
+    if not py:
+        return {}
+    with ProcessPoolExecutor(max_workers=min(workers, len(py))) as pool:
+        results = list(pool.map(_compile_one, [str(root / p) for p in py]))
+    return {
+        Path(path).relative_to(root).as_posix(): err
+        for path, err in results
+        if err
+    }
+
+
+def module_names(rel_path: str, root: Path) -> List[str]:
+    """
+    文件对应的模块名：完整路径名，以及剥离掉「非包」前缀目录（如 src/）后的名字
+    """
+    parts = list(Path(rel_path).with_suffix("").parts)
+    if parts and parts[-1] == "__init__":
+        parts = parts[:-1]
+    names: List[str] = []
+    if parts:
+        names.append(".".join(parts))
+    i = 0
+    while i < len(parts) - 1 and not (root.joinpath(*parts[:i + 1]) / "__init__.py").exists():
+        i += 1
+        names.append(".".join(parts[i:]))
+    return names
+
+
+def _imports_of(path: Path, module: str, is_pkg: bool) -> Set[str]:
+    """解析文件中的 import（包括相对 import），返回可能的模块名集合"""
+    try:
+        tree = ast.parse(path.read_bytes())
+    except (SyntaxError, ValueError):
+        return set()
+
+    package = module if is_pkg else module.rpartition(".")[0]
+    out: Set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            for a in node.names:
+                out.add(a.name)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ""
+            if node.level:
+                pkg_parts = package.split(".") if package else []
+                pkg_parts = pkg_parts[:len(pkg_parts) - (node.level - 1)] if node.level > 1 else pkg_parts
+                base = ".".join([p for p in pkg_parts + [base] if p])
+            if base:
+                out.add(base)
+            for a in node.names:
+                out.add(f"{base}.{a.name}" if base else a.name)
+    return out
+
+
+def is_test_file(rel_path: str) -> bool:
+    name = Path(rel_path).name
+    return name.startswith("test_") or name.endswith("_test.py") or "tests" in Path(rel_path).parts
+
+
+def select_tests(root: Path, py_files: List[str], changed: List[str]) -> List[str]:
+    """
+    基于 AST import 图选择测试：
+    反向遍历 import 边，找出直接或间接 import 了被修改模块的测试文件
+    """
+    name_to_file: Dict[str, str] = {}
+    file_names: Dict[str, List[str]] = {}
+    for f in py_files:
+        names = module_names(f, root)
+        file_names[f] = names
+        for n in names:
+            name_to_file.setdefault(n, f)
+
+    def resolve(name: str) -> Optional[str]:
+        # a.b.c 不存在时退回到 a.b（from pkg import name 的情况）
+        while name:
+            if name in name_to_file:
+                return name_to_file[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    importers: Dict[str, Set[str]] = {}
+    for f in py_files:
+        if not file_names[f]:
+            continue
+        is_pkg = Path(f).name == "__init__.py"
+        for imp in _imports_of(root / f, file_names[f][0], is_pkg):
+            target = resolve(imp)
+            if target and target != f:
+                importers.setdefault(target, set()).add(f)
+
+    seen: Set[str] = set(changed)
+    queue = list(changed)
+    while queue:
+        cur = queue.pop()
+        for dep in importers.get(cur, ()):
+            if dep not in seen:
+                seen.add(dep)
+                queue.append(dep)
+
+    return sorted(f for f in seen if is_test_file(f) and f in file_names)
+
+
+def _cache_key(patch: str, head: str) -> str:
+    return hashlib.sha1((head + "\n" + patch).encode("utf-8")).hexdigest()
+
+
+def _verify_in_worktree(
+    repo_root: Path,
+    work: Path,
+    patch_path: Path,
+    head: str,
+    report: VerifyReport,
+    test_timeout: int,
+    workers: int,
+) -> None:
+    def step(name: str, t0: float) -> None:
+        report.steps[name] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    try:
+        add_worktree(repo_root, work, head)
+    except RuntimeError as e:
+        report.error = report.infra_error = f"无法创建 worktree: {e}"
+        return
+    step("worktree", t0)
+
+    t0 = time.perf_counter()
+    ok, msg = apply_patch(work, patch_path.resolve())
+    step("apply", t0)
+    if not ok:
+        # patch 是对工作区生成并检查的，worktree 检出的是 HEAD：
+        # 无法应用多半是被修改文件有未提交改动，属于环境问题，不缓存
+        report.error = msg
+        dirty = dirty_files(repo_root, report.touched)
+        report.infra_error = (
+            f"被修改文件有未提交改动，无法在 HEAD 上验证: {', '.join(dirty)}"
+            if dirty else "patch 无法应用到 HEAD 的 worktree"
+        )
+        return
+
+    t0 = time.perf_counter()
+    report.compile_errors = compile_files(work, report.touched, workers)
+    step("compile", t0)
+    if report.compile_errors:
+        report.error = "byte-compile 失败"
+        return
+
+    t0 = time.perf_counter()
+    py_files = sorted(set(
+        [f for f in list_tracked_files(work) if f.endswith(".py")]
+        + [f for f in report.touched if f.endswith(".py")]
+    ))
+    report.tests = select_tests(work, py_files, [f for f in report.touched if f in py_files])
+    step("select_tests", t0)
+
+    if report.tests and importlib.util.find_spec("pytest") is None:
+        # 测试步骤跳过（tests_ok 保持 None），不把缺少 pytest 当成 patch 失败
+        report.infra_error = "未安装 pytest，跳过测试"
+    elif report.tests:
+        t0 = time.perf_counter()
+        try:
+            p = subprocess.run(
+                [sys.executable, "-m", "pytest", "-q", *report.tests],
+                cwd=str(work),
+                capture_output=True,
+                text=True,
+                timeout=test_timeout,
+            )
+            report.tests_ok = p.returncode in (0, PYTEST_NO_TESTS)
+            report.output = (p.stdout + p.stderr)[-4000:]
+            if p.returncode in PYTEST_INFRA_CODES:
+                report.infra_error = f"pytest 退出码 {p.returncode}"
+        except subprocess.TimeoutExpired:
+            report.tests_ok = False
+            report.output = f"pytest 超时（{test_timeout}s）"
+            report.infra_error = report.output
+        step("tests", t0)
+
+    report.ok = report.tests_ok is not False
+
+
+def verify_patch(
+    repo_root: Path,
+    patch_path: Path,
+    head: str,
+    cache_dir: Optional[Path] = None,
+    test_timeout: int = 600,
+    workers: int = 4,
+) -> VerifyReport:
+    """
+    在临时 git worktree 中验证 patch：
+    1. 应用 patch
+    2. 并行 byte-compile 被修改的文件
+    3. 只运行直接或间接 import 了被修改模块的测试（pytest）
+    结果按 (patch hash, HEAD) 缓存；超时与环境问题（infra_error）不缓存，下次重新验证
+    """
+    patch = patch_path.read_text(encoding="utf-8")
+    cache_file: Optional[Path] = None
+    if cache_dir is not None:
+        cache_file = cache_dir / f"{_cache_key(patch, head)}.json"
+        if cache_file.exists():
+            try:
+                report = VerifyReport(**json.loads(cache_file.read_text(encoding="utf-8")))
+                report.cached = True
+                return report
+            except (ValueError, TypeError):
+                pass
+
+    report = VerifyReport(touched=touched_files(patch))
+    tmp = Path(tempfile.mkdtemp(prefix="langpatch_verify_"))
+    work = tmp / "wt"
+    try:
+        _verify_in_worktree(repo_root, work, patch_path, head, report, test_timeout, workers)
+    finally:
+        t0 = time.perf_counter()
+        if work.exists():
+            try:
+                remove_worktree(repo_root, work)
+            except RuntimeError:
+                pass
+        shutil.rmtree(tmp, ignore_errors=True)
+        report.steps["cleanup"] = time.perf_counter() - t0
+
+    if cache_file is not None and not report.infra_error:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        cache_file.write_text(
+            json.dumps(asdict(report), indent=2, ensure_ascii=False),
+            encoding="utf-8",
+        )
+    return report
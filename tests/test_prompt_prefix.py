@@ -0,0 +1,124 @@
+"""
+用本地 OpenAI 兼容桩服务验证 prompt 前缀结构：
+同一 plan 的逐文件调用共享「system + 需求」前缀，同一文件的修复调用再共享文件块；
+同时验证 get_usage 能解析 DeepSeek 的 prompt_cache_hit_tokens。
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os.path import commonprefix
+
+import pytest
+
+from langpatch.config import Settings
+from langpatch.llm import UsageMeter
+from langpatch.patcher import generate_file_patch, repair_file_patch
+from langpatch.prompt_layout import common_prefix_chars, patch_layout, repair_layout
+from langpatch.prompts import PATCH_FILE, PATCH_REQUIREMENT, PATCH_SYSTEM
+
+REQUIREMENT = "把所有常量改为 2"
+NOTES = ["只修改常量定义"]
+STUB_DIFF = "@@ -1 +1 @@\n-x = 1\n+x = 2\n"
+CACHE_HIT = 64
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    bodies: list = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.bodies.append(body)
+        payload = json.dumps({
+            "id": "stub",
+            "object": "chat.completion",
+            "created": 0,
+            "model": body.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": STUB_DIFF},
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": 100,
+                "completion_tokens": 10,
+                "total_tokens": 110,
+                "prompt_cache_hit_tokens": CACHE_HIT,
+                "prompt_cache_miss_tokens": 100 - CACHE_HIT,
+            },
+        }).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server():
+    _StubHandler.bodies = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def repo(tmp_path):
+    (tmp_path / "a.py").write_text("x = 1\n", encoding="utf-8")
+    (tmp_path / "b.py").write_text("x = 1\ny = 1\n", encoding="utf-8")
+    return tmp_path
+
+
+def _messages(body):
+    msgs = {m["role"]: m["content"] for m in body["messages"]}
+    return msgs["system"], msgs["user"]
+
+
+def test_prefix_structure_and_cache_hits(stub_server, repo, monkeypatch):
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1")
+    settings = Settings(
+        deepseek_api_key="test",
+        deepseek_base_url=f"http://127.0.0.1:{stub_server.server_port}/v1",
+        deepseek_model="stub",
+        llm_max_retries=0,
+    )
+    meter = UsageMeter()
+
+    common = dict(settings=settings, repo_root=repo, requirement=REQUIREMENT, design_notes=NOTES, meter=meter)
+    fp_a = generate_file_patch(rel_path="a.py", **common)
+    generate_file_patch(rel_path="b.py", **common)
+    repair_file_patch(rel_path="a.py", bad_diff=fp_a.diff, error="error: patch failed: a.py:1", **common)
+
+    assert len(_StubHandler.bodies) == 3
+    (sys_a, user_a), (sys_b, user_b), (sys_r, user_r) = map(_messages, _StubHandler.bodies)
+
+    requirement_block = PATCH_REQUIREMENT.format(requirement=REQUIREMENT, design_notes="- " + NOTES[0])
+    file_block_a = PATCH_FILE.format(path="a.py", content="x = 1\n")
+
+    # 不同文件：system 相同，user 消息共享需求块，到文件块才分叉
+    assert sys_a == sys_b == sys_r == PATCH_SYSTEM
+    shared = commonprefix([user_a, user_b])
+    assert shared.startswith(requirement_block)
+    assert not shared.startswith(requirement_block + file_block_a)
+
+    # 同一文件的修复：再共享文件块，只有末尾的任务块不同
+    assert commonprefix([user_a, user_r]).startswith(requirement_block + file_block_a)
+    assert user_r != user_a
+
+    # 请求体与本地 layout 一致，common_prefix_chars 给出同样的共享前缀
+    layout_a = patch_layout(REQUIREMENT, NOTES, "a.py", "x = 1\n")
+    layout_r = repair_layout(REQUIREMENT, NOTES, "a.py", "x = 1\n", "diff", "err", "excerpt")
+    assert layout_a.render() == user_a
+    assert common_prefix_chars(layout_a, layout_r) >= len(PATCH_SYSTEM + "\n" + requirement_block + file_block_a)
+
+    # get_usage 解析 DeepSeek 的缓存命中字段
+    assert meter.calls == 3
+    assert meter.cache_hit_tokens == 3 * CACHE_HIT
+    assert meter.cache_miss_tokens == 3 * (100 - CACHE_HIT)